@@ -1,13 +1,24 @@
 import json
 
-from flask import Flask, request, jsonify
-import requests
+from flask import Flask, Response, request, jsonify
 import os
 import logging
+import threading
 from dotenv import load_dotenv
 from flask_cors import CORS
-import lmstudio as lms
-from ytmusicapi import YTMusic
+
+# Load .env before the local modules below read their settings
+load_dotenv()
+
+import llm
+import jobs
+import metrics
+import ratelimit
+import http_client
+import recommender
+import spotify_api
+import singleflight
+import emotion as emotion_detector
 
 
 # Initialize Flask app
@@ -18,22 +29,64 @@ CORS(app)  # Enable CORS for all routes
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
 # API credentials
 CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID", "97debce860cb4f6caafe1e5f67b97a8b")
 CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET", "35fa27bd5b0a48919ce00c1cd86675b5")
 REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI", "https://nullify-jt6x.onrender.com/callback")
-LASTFM_API_KEY = os.getenv("LASTFM_API_KEY", "894c8fa3285772930a82e00d410c5fd3")
 
-# Initialize YouTube Music API
-try:
-    yt = YTMusic()
-except Exception as e:
-    logger.error(f"Failed to initialize YTMusic: {str(e)}")
-    yt = None
-from flask import send_file
-import tempfile
+# Batched emotion detection: texts per LLM prompt (default and most a client may ask for),
+# parallel prompts, and request size cap
+EMOTION_BATCH_SIZE = int(os.getenv("EMOTION_BATCH_SIZE", "20"))
+EMOTION_BATCH_MAX = int(os.getenv("EMOTION_BATCH_MAX", "50"))
+EMOTION_BATCH_CONCURRENCY = int(os.getenv("EMOTION_BATCH_CONCURRENCY", "4"))
+EMOTION_BATCH_MAX_TEXTS = int(os.getenv("EMOTION_BATCH_MAX_TEXTS", "10000"))
+
+# Pooled keep-alive session for the token exchange
+spotify = http_client.session("spotify")
+
+# Server-side Spotify sessions; clients send session_id instead of holding tokens themselves
+spotify_tokens = spotify_api.TokenManager(CLIENT_ID, CLIENT_SECRET)
+
+
+def request_access_token(data):
+    """Access token for a request body carrying a session_id or a raw access_token"""
+    if data.get('session_id'):
+        return spotify_tokens.access_token(data['session_id'])
+    return data.get('access_token')
+
+
+def request_state(data):
+    """Recommendation state for the listener session a request belongs to, or None"""
+    if data.get('session_id'):
+        return recommender.session_state(f"session:{data['session_id']}")
+    if data.get('access_token'):
+        return recommender.session_state(f"token:{spotify_api.token_key(data['access_token'])}")
+    return None
+
+@app.before_request
+def start_request_trace():
+    metrics.start_trace()
+
+
+@app.after_request
+def finish_request_trace(response):
+    # Streaming responses report the stages finished before their first byte
+    trace = metrics.current_trace()
+    if trace is not None:
+        response.headers["Server-Timing"] = trace.server_timing()
+        metrics.request_seconds.observe(trace.elapsed(), endpoint=request.endpoint or "unknown",
+                                        status=response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+from playlists import EXPORT_FORMATS, PlaylistStore, PlaylistTooLarge, export
+
+playlist_store = PlaylistStore()
 
 
 @app.route('/create_playlist', methods=['POST'])
@@ -44,21 +97,17 @@ def create_playlist():
 
         recommendations = request.json['recommendations']
 
-        # Create a temporary M3U playlist file
-        with tempfile.NamedTemporaryFile(mode='w+', suffix='.m3u', delete=False) as temp_file:
-            temp_file.write("#EXTM3U\n")
-            for track in recommendations:
-                if 'yt_link' in track:
-                    temp_file.write(f"#EXTINF:-1,{track['artist']} - {track['track']}\n")
-                    temp_file.write(f"{track['yt_link']}\n")
-
-            temp_file_path = temp_file.name
+        # Keep the track list in memory; identical playlists share one stored copy
+        playlist_id = playlist_store.put_tracks(recommendations)
 
         return jsonify({
-            "playlist_url": f"/download_playlist?path={temp_file_path}",
+            "playlist_url": f"/download_playlist?id={playlist_id}",
+            "formats": list(EXPORT_FORMATS),
             "message": "Playlist created successfully"
         })
 
+    except PlaylistTooLarge as e:
+        return jsonify({"error": "Playlist too large", "detail": str(e)}), 413
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -66,13 +115,29 @@ def create_playlist():
 @app.route('/download_playlist')
 def download_playlist():
     try:
-        file_path = request.args.get('path')
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name='music_recommendations.m3u',
-            mimetype='audio/x-mpegurl'
-        )
+        # Pick the format from ?format=, else from the Accept header, else M3U
+        fmt = request.args.get('format')
+        if fmt is None:
+            mimetypes = {mimetype: name for name, (_, mimetype, _) in EXPORT_FORMATS.items()}
+            fmt = mimetypes.get(request.accept_mimetypes.best_match(list(mimetypes)), "m3u")
+        fmt = fmt.lower()
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({"error": f"Unsupported format: {fmt}", "formats": list(EXPORT_FORMATS)}), 400
+
+        playlist_id = request.args.get('id')
+        tracks = playlist_store.get_tracks(playlist_id) if playlist_id else None
+        if tracks is None:
+            return jsonify({"error": "Playlist not found or expired"}), 404
+
+        _, mimetype, extension = EXPORT_FORMATS[fmt]
+        response = Response(export(fmt, tracks), mimetype=mimetype)
+        response.headers["Content-Disposition"] = f"attachment; filename=music_recommendations.{extension}"
+        response.headers["Vary"] = "Accept"
+        response.cache_control.max_age = int(playlist_store.ttl)
+
+        # Content-addressed, so id plus format is a strong ETag and If-None-Match gets a 304
+        response.set_etag(f"{playlist_id}.{fmt}")
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -82,6 +147,29 @@ def health_check():
     return jsonify({"status": "healthy", "service": "music-recommendation-api"})
 
 
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify({
+        "lastfm": recommender.lastfm_cache.stats(),
+        "yt_index": recommender.video_index.stats(),
+        "llm": llm.stats(),
+        "emotion_local": emotion_detector.local_tier.stats(),
+        "candidate_pools": recommender.candidate_pools.stats() if recommender.candidate_pools else None,
+        "spotify_profiles": spotify_api.stats(),
+        "spotify_sessions": spotify_tokens.stats(),
+        "session_states": recommender.session_states.stats(),
+        "playlists": playlist_store.stats(),
+        "singleflight": singleflight.stats(),
+        "jobs": job_queue.stats()
+    })
+
+
+@app.route('/rate_limits')
+def rate_limits():
+    """Current token budget, waiters and throttling per upstream"""
+    return jsonify(ratelimit.stats())
+
+
 @app.route('/detect_emotion', methods=['POST'])
 def detect_emotion():
     try:
@@ -91,14 +179,7 @@ def detect_emotion():
         text = request.json['text']
         logger.info(f"Detecting emotion for text: {text[:50]}...")
 
-        model = lms.llm()
-        chat = lms.Chat("You are an emotion detection expert. "
-                        "Respond ONLY with: emotion: [label]")
-        chat.add_user_message(
-            f"Detect the sentiment emotions with around maximum of 5 labels in this text: \"{text}\"")
-
-        response = model.respond(chat).content.strip()
-        emotion = response.split(':')[-1].strip().lower()
+        emotion = emotion_detector.detect(text)
 
         logger.info(f"Detected emotion: {emotion}")
         return jsonify({"emotion": emotion})
@@ -108,6 +189,40 @@ def detect_emotion():
         return jsonify({"error": "Failed to detect emotion", "detail": str(e)}), 500
 
 
+@app.route('/detect_emotion/batch', methods=['POST'])
+def detect_emotion_batch():
+    """Classify many texts, streaming NDJSON lines as each chunk finishes"""
+    if not request.json or not isinstance(request.json.get('texts'), list):
+        return jsonify({"error": "Missing texts array in request"}), 400
+
+    texts = request.json['texts']
+    if not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "All texts must be strings"}), 400
+
+    if len(texts) > EMOTION_BATCH_MAX_TEXTS:
+        return jsonify({"error": f"Too many texts (max {EMOTION_BATCH_MAX_TEXTS})"}), 400
+
+    try:
+        chunk_size = int(request.json.get('chunk_size', EMOTION_BATCH_SIZE))
+        concurrency = int(request.json.get('concurrency', EMOTION_BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "chunk_size and concurrency must be integers"}), 400
+    chunk_size = min(max(1, chunk_size), EMOTION_BATCH_MAX)
+    concurrency = min(max(1, concurrency), EMOTION_BATCH_CONCURRENCY)
+
+    logger.info(f"Detecting emotion for {len(texts)} texts in chunks of {chunk_size}")
+
+    def generate():
+        for start, labels, error in emotion_detector.detect_batch(texts, chunk_size, concurrency):
+            for offset, label in enumerate(labels):
+                line = {"index": start + offset, "emotion": label}
+                if error:
+                    line["error"] = error
+                yield json.dumps(line) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
 @app.route('/get_spotify_token', methods=['POST'])
 def get_spotify_token():
     try:
@@ -117,7 +232,7 @@ def get_spotify_token():
         auth_code = request.json['auth_code']
         logger.info("Received request for Spotify token exchange")
 
-        token_url = "https://accounts.spotify.com/api/token"
+        token_url = spotify_api.TOKEN_URL
         data = {
             "grant_type": "authorization_code",
             "code": auth_code,
@@ -131,7 +246,8 @@ def get_spotify_token():
         }
 
         logger.debug(f"Sending request to Spotify with data: {data}")
-        response = requests.post(token_url, data=data, headers=headers)
+        with metrics.span("spotify_token"):
+            response = spotify.post(token_url, data=data, headers=headers)
 
         if response.status_code != 200:
             error_detail = response.json().get('error_description', 'No error details')
@@ -143,10 +259,12 @@ def get_spotify_token():
 
         tokens = response.json()
         logger.info("Successfully obtained Spotify tokens")
+        session_id = spotify_tokens.create(tokens)
 
         return jsonify({
+            "session_id": session_id,
+            # Deprecated: for clients that still call Spotify themselves; use session_id instead
             "access_token": tokens.get("access_token"),
-            "refresh_token": tokens.get("refresh_token"),
             "expires_in": tokens.get("expires_in")
         })
 
@@ -161,48 +279,22 @@ def get_spotify_token():
 @app.route('/get_user_data', methods=['POST'])
 def get_user_data():
     try:
-        if not request.json or 'access_token' not in request.json:
-            return jsonify({"error": "Missing access_token in request"}), 400
+        if not request.json or ('access_token' not in request.json and 'session_id' not in request.json):
+            return jsonify({"error": "Missing access_token or session_id in request"}), 400
 
-        access_token = request.json['access_token']
         logger.info("Fetching Spotify user data")
 
-        headers = {
-            "Authorization": f"Bearer {access_token}"
-        }
-
-        # Get user profile
-        user_profile_url = "https://api.spotify.com/v1/me"
-        response = requests.get(user_profile_url, headers=headers)
-
-        if response.status_code != 200:
-            error_detail = response.json().get('error', {}).get('message', 'Unknown error')
-            logger.error(f"Spotify user profile error: {response.status_code} - {error_detail}")
+        try:
+            access_token = request_access_token(request.json)
+            profile = spotify_api.get_profile(access_token)
+        except spotify_api.SpotifyError as e:
+            logger.error(f"Spotify user profile error: {e.status_code} - {e.detail}")
             return jsonify({
-                "error": f"Failed to get user profile: {response.status_code}",
-                "detail": error_detail
-            }), response.status_code
-
-        profile_data = response.json()
-
-        # Get top artists
-        top_artists_url = "https://api.spotify.com/v1/me/top/artists?time_range=medium_term&limit=5"
-        response = requests.get(top_artists_url, headers=headers)
-
-        top_artists = []
-        genres = set()
+                "error": f"Failed to get user profile: {e.status_code}",
+                "detail": e.detail
+            }), e.status_code
 
-        if response.status_code == 200:
-            top_artists = response.json().get("items", [])
-            for artist in top_artists:
-                genres.update(artist.get("genres", []))
-
-        return jsonify({
-            "user_id": profile_data.get("id"),
-            "country": profile_data.get("country", "US"),
-            "genres": list(genres),
-            "top_artists": [artist["name"] for artist in top_artists]
-        })
+        return jsonify(profile)
 
     except Exception as e:
         logger.error(f"User data error: {str(e)}")
@@ -219,105 +311,30 @@ def get_recommendations():
         if not request.json:
             return jsonify({"error": "Missing request body"}), 400
 
-        if 'access_token' not in request.json:
-            return jsonify({"error": "Missing access_token"}), 400
+        if 'access_token' not in request.json and 'session_id' not in request.json:
+            return jsonify({"error": "Missing access_token or session_id"}), 400
 
         if 'emotion' not in request.json:
             return jsonify({"error": "Missing emotion"}), 400
 
-        access_token = request.json['access_token']
         emotion = request.json['emotion']
 
         logger.info(f"Starting recommendation process for emotion: {emotion}")
 
-        # Step 1: Get user data
-        headers = {"Authorization": f"Bearer {access_token}"}
-
-        # Get user profile
-        profile_url = "https://api.spotify.com/v1/me"
-        profile_response = requests.get(profile_url, headers=headers)
-
-        if profile_response.status_code != 200:
-            error = profile_response.json().get('error', {})
-            return jsonify({
-                "error": "Failed to get user profile",
-                "detail": error.get('message', 'Unknown error')
-            }), profile_response.status_code
-
-        profile_data = profile_response.json()
-        country = profile_data.get('country', 'US')
-
-        # Get top artists
-        artists_url = "https://api.spotify.com/v1/me/top/artists?time_range=medium_term&limit=5"
-        artists_response = requests.get(artists_url, headers=headers)
-
-        genres = set()
-        if artists_response.status_code == 200:
-            for artist in artists_response.json().get('items', []):
-                genres.update(artist.get('genres', []))
-
-        # Step 2: Generate emotion tags
-        model = lms.llm()
-        chat = lms.Chat("You are a music recommendation expert. "
-                        "Respond ONLY with a comma-separated list of emotion-related tags.")
-        prompt = f"""
-        For the emotion "{emotion}", and considering these genres: {', '.join(genres)} 
-        and country: {country}, generate 5 music tags.
-        Respond ONLY with comma-separated tags.
-        """
-        chat.add_user_message(prompt)
-        response = model.respond(chat).content.strip()
-        tags = [tag.strip() for tag in response.split(",") if tag.strip()]
-
-        if not tags:
-            return jsonify({"error": "Failed to generate tags"}), 500
-
-        # Step 3: Get recommendations from Last.fm
-        base_url = "http://ws.audioscrobbler.com/2.0/"
-        recommendations = []
-
-        for tag in tags[:3]:  # Limit to 3 tags to avoid too many requests
-            params = {
-                "method": "tag.gettoptracks",
-                "tag": tag,
-                "api_key": LASTFM_API_KEY,
-                "format": "json",
-                "limit": 5
-            }
-            response = requests.get(base_url, params=params)
-
-            if response.status_code == 200:
-                data = response.json()
-                tracks = data.get('tracks', {}).get('track', [])
-                for track in tracks:
-                    recommendations.append({
-                        "track": track.get('name'),
-                        "artist": track.get('artist', {}).get('name'),
-                        "tag": tag
-                    })
-
-        if not recommendations:
-            return jsonify({"error": "No tracks found for these tags"}), 404
-
-        # Step 4: Add YouTube links
-        if yt:
-            for track in recommendations[:10]:  # Limit to 10 to avoid timeout
-                try:
-                    results = yt.search(f"{track['track']} {track['artist']}")
-                    for item in results:
-                        if item["resultType"] == "video":
-                            track["yt_link"] = f"https://music.youtube.com/watch?v={item['videoId']}"
-                            break
-                except Exception as e:
-                    logger.warning(f"Couldn't get YT link for {track['track']}: {str(e)}")
-                    continue
-
-        return jsonify({
-            "recommendations": recommendations,
-            "emotion": emotion,
-            "genres": list(genres),
-            "country": country
-        })
+        try:
+            access_token = request_access_token(request.json)
+        except spotify_api.SpotifyError as e:
+            return jsonify({"error": "Failed to get Spotify token", "detail": e.detail}), e.status_code
+
+        try:
+            return jsonify(recommender.get_recommendations(
+                access_token, emotion, request.json.get('resolve', recommender.YT_RESOLVE_MODE),
+                request_state(request.json)))
+        except recommender.RecommendationError as e:
+            body = {"error": e.error}
+            if e.detail:
+                body["detail"] = e.detail
+            return jsonify(body), e.status_code
 
     except Exception as e:
         logger.error(f"Recommendation error: {str(e)}")
@@ -327,44 +344,169 @@ def get_recommendations():
         }), 500
 
 
-@app.route('/process_feedback', methods=['POST'])
-def process_feedback():
-    """Process user feedback using LM Studio and update recommendations"""
-    data = request.json
+@app.route('/get_recommendations/stream', methods=['POST'])
+def get_recommendations_stream():
+    """Stream pipeline progress as NDJSON: tags, then tracks, then YouTube links"""
+    if not request.json:
+        return jsonify({"error": "Missing request body"}), 400
+
+    if 'access_token' not in request.json and 'session_id' not in request.json:
+        return jsonify({"error": "Missing access_token or session_id"}), 400
+
+    if 'emotion' not in request.json:
+        return jsonify({"error": "Missing emotion"}), 400
+
+    emotion = request.json['emotion']
+
+    logger.info(f"Starting streamed recommendation process for emotion: {emotion}")
 
-    # Initialize LM Studio model
-    model = lms.llm()
-    chat = lms.Chat("""
+    try:
+        access_token = request_access_token(request.json)
+    except spotify_api.SpotifyError as e:
+        return jsonify({"error": "Failed to get Spotify token", "detail": e.detail}), e.status_code
+
+    events = recommender.recommendation_events(
+        access_token, emotion, resolve=request.json.get('resolve', recommender.YT_RESOLVE_MODE),
+        state=request_state(request.json))
+
+    # Run up to the first event here so profile and tag failures keep their status codes
+    try:
+        first_event = next(events)
+    except recommender.RecommendationError as e:
+        return jsonify({"error": e.error, "detail": e.detail}), e.status_code
+    except Exception as e:
+        logger.error(f"Recommendation error: {str(e)}")
+        return jsonify({"error": "Internal server error", "detail": str(e)}), 500
+
+    def generate():
+        yield json.dumps(first_event) + "\n"
+        try:
+            for event in events:
+                yield json.dumps(event) + "\n"
+        except recommender.RecommendationError as e:
+            yield json.dumps({"event": "error", "error": e.error, "status": e.status_code}) + "\n"
+        except Exception as e:
+            logger.error(f"Recommendation stream error: {str(e)}")
+            yield json.dumps({"event": "error", "error": "Internal server error", "detail": str(e)}) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
+
+
+def resolve_input(data):
+    """Validation error for a /resolve body, or None"""
+    tracks = data.get('tracks') if data else None
+    if not isinstance(tracks, list):
+        return "Missing tracks array in request"
+    if not all(isinstance(track, dict) and track.get('track') for track in tracks):
+        return "Each track needs at least a track name"
+    if len(tracks) > recommender.YT_RESOLVE_BATCH_MAX:
+        return f"Too many tracks (max {recommender.YT_RESOLVE_BATCH_MAX})"
+    return None
+
+
+@app.route('/resolve', methods=['POST'])
+def resolve_links():
+    """Resolve YouTube Music links for a batch of tracks returned without them"""
+    invalid = resolve_input(request.json)
+    if invalid:
+        return jsonify({"error": invalid}), 400
+
+    links = recommender.resolve_yt_links(request.json['tracks'])
+    # null means no video exists; indexes in "unresolved" ran out of time and can be retried
+    return jsonify({
+        "yt_links": [link or None for link in links],
+        "unresolved": [index for index, link in enumerate(links) if link is False]
+    })
+
+
+FEEDBACK_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "response": {"type": "string", "minLength": 1},
+        "mood_adjustment": {"type": "string", "enum": ["more_energetic", "more_calm", "no_change"]},
+        "new_tags": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 1, "maxItems": 8}
+    },
+    "required": ["response", "mood_adjustment", "new_tags"]
+}
+
+
+def feedback_fallback(tags):
+    """Answer used when the model gives nothing usable: acknowledge and keep the current tags"""
+    if isinstance(tags, str):
+        tags = recommender.parse_tags(tags)
+    return {
+        "response": "Thanks for the feedback! I'll keep this vibe going for now.",
+        "mood_adjustment": "no_change",
+        "new_tags": list(tags or [])
+    }
+
+
+def analyze_feedback(data, state=None):
+    """Ask the LLM for a reply, mood adjustment and new tags for a piece of feedback"""
+    system_prompt = """
     You are a music recommendation assistant analyzing user feedback. 
-    Respond with JSON containing: 
+    Respond ONLY with JSON containing: 
     - response: string (friendly reply)
     - mood_adjustment: string (more_energetic|more_calm|no_change)
     - new_tags: array (3-5 music tags based on feedback)
-    """)
+    """
+
+    # The session remembers the mood, tags and recent turns; fall back to what the client sent
+    mood = state.emotion if state and state.emotion else data.get('current_mood')
+    tags = state.tags if state and state.tags else data.get('current_tags')
+    earlier = "".join(f"""
+    Earlier feedback: {feedback} -> tags {turn_tags}""" for feedback, turn_tags in (state.feedback if state else []))
 
     # Build context for the model
     context = f"""
-    Current mood: {data.get('current_mood')}
+    Current mood: {mood}
     Current track: {data.get('current_track')}
     User feedback: {data.get('feedback')}
-    Previous tags: {data.get('current_tags')}
+    Previous tags: {tags}{earlier}
     """
 
-    chat.add_user_message(f"""
+    user_message = f"""
     Analyze this music feedback and suggest adjustments:
     {context}
-    """)
+    """
+
+    # Get structured response from LM Studio; if none comes back, keep the current tags
+    with metrics.span("llm_feedback"):
+        response_data = llm.complete_json(system_prompt, user_message, FEEDBACK_SCHEMA, "feedback",
+                                          fallback=lambda content: feedback_fallback(tags))
+    if state is not None:
+        state.feedback.append((data.get('feedback'), response_data.get('new_tags')))
+    return response_data
+
+
+def feedback_tracks(data, state, response_data):
+    """New recommendations for a feedback reply, built on what the session found before"""
+    played = [track for track in data.get('played', []) if isinstance(track, dict)]
+    if isinstance(data.get('current_track'), dict):
+        played.append(data['current_track'])
+
+    return recommender.feedback_recommendations(
+        state,
+        response_data['new_tags'],
+        request_access_token(data),
+        mood_adjustment=response_data.get('mood_adjustment', "no_change"),
+        played=played
+    )
+
+
+@app.route('/process_feedback', methods=['POST'])
+def process_feedback():
+    """Process user feedback using LM Studio and update recommendations"""
+    data = request.json
+    if not data or ('access_token' not in data and 'session_id' not in data):
+        return jsonify({"success": False, "error": "Missing access_token or session_id"}), 400
 
     try:
-        # Get structured response from LM Studio
-        result = model.respond(chat).content.strip()
-        response_data = json.loads(result)
+        state = request_state(data)
+        response_data = analyze_feedback(data, state)
 
-        # Generate new recommendations based on adjusted tags
-        new_recommendations = get_recommendations_by_tags(
-            response_data['new_tags'],
-            data.get('access_token')
-        )
+        # Apply the adjusted tags to the session's state, fetching only what is new
+        new_recommendations = feedback_tracks(data, state, response_data)
 
         return jsonify({
             "success": True,
@@ -373,6 +515,10 @@ def process_feedback():
             "recommendations": new_recommendations
         })
 
+    except recommender.RecommendationError as e:
+        return jsonify({"success": False, "error": e.error, "detail": e.detail}), e.status_code
+    except spotify_api.SpotifyError as e:
+        return jsonify({"success": False, "error": "Failed to get user profile", "detail": e.detail}), e.status_code
     except Exception as e:
         return jsonify({
             "success": False,
@@ -380,46 +526,147 @@ def process_feedback():
         }), 500
 
 
-def get_recommendations_by_tags(tags, access_token):
-    """Get recommendations based on specific tags"""
-    recommendations = []
+def recommendations_job(payload, job):
+    """Background /get_recommendations: pipeline events become the job's partial results"""
+    access_token = request_access_token(payload)
+    body = {"recommendations": []}
+    resolve = payload.get('resolve', recommender.YT_RESOLVE_MODE)
+    for event in recommender.recommendation_events(access_token, payload['emotion'], resolve=resolve,
+                                                   state=request_state(payload)):
+        recommender.apply_event(body, event)
+        job.emit(event)
+    return body
+
+
+def feedback_job(payload, job):
+    """Background /process_feedback: the LLM reply is emitted before the new tracks are fetched"""
+    state = request_state(payload)
+    response_data = analyze_feedback(payload, state)
+    job.emit({
+        "event": "reply",
+        "bot_response": response_data['response'],
+        "mood_adjustment": response_data['mood_adjustment'],
+        "new_tags": response_data['new_tags']
+    })
+    # Fetching tracks is the slow part; don't start it, or keep its result, once cancelled
+    job.check()
+    new_recommendations = feedback_tracks(payload, state, response_data)
+    job.check()
+    return {
+        "success": True,
+        "bot_response": response_data['response'],
+        "mood_adjustment": response_data['mood_adjustment'],
+        "recommendations": new_recommendations
+    }
+
+
+# Required fields per job kind, on top of access_token or session_id
+JOB_FIELDS = {
+    "recommendations": ("emotion",),
+    "feedback": ("feedback",),
+}
+
+job_queue = jobs.JobQueue()
+job_queue.register("recommendations", recommendations_job)
+job_queue.register("feedback", feedback_job)
+
+_background_started = False
+_background_lock = threading.Lock()
+
+
+@app.before_request
+def start_background_services():
+    """Start pool warming, model loading and job workers once per serving process.
+
+    Runs on the first request rather than at import, so importing this module,
+    or the debug reloader's watcher process, starts no background traffic.
+    """
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+
+    # Keep candidate pools for common moods warm in the background
+    if recommender.candidate_pools:
+        recommender.candidate_pools.start()
+    # Load each routed model tier ahead of the requests that need it
+    llm.warm_models()
+    if jobs.JOB_WORKERS > 0:
+        job_queue.start()
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue recommendation or feedback work and return its id right away"""
+    data = request.json
+    if not data:
+        return jsonify({"error": "Missing request body"}), 400
 
-    # Get user preferences first
-    user_data = get_user_data(access_token)
+    kind = data.get('kind')
+    if kind not in JOB_FIELDS:
+        return jsonify({"error": f"Unknown job kind: {kind}", "kinds": list(JOB_FIELDS)}), 400
 
-    for tag in tags:
-        # Combine tag with user preferences
-        search_query = f"{tag} {user_data['genres'][0]}"
+    if 'access_token' not in data and 'session_id' not in data:
+        return jsonify({"error": "Missing access_token or session_id"}), 400
+
+    missing = [field for field in JOB_FIELDS[kind] if field not in data]
+    if missing:
+        return jsonify({"error": f"Missing {', '.join(missing)}"}), 400
+
+    try:
+        priority = int(data.get('priority', jobs.PRIORITY_NORMAL))
+    except (TypeError, ValueError):
+        return jsonify({"error": "priority must be an integer"}), 400
+
+    payload = {key: value for key, value in data.items() if key not in ('kind', 'priority')}
+    try:
+        job_id = job_queue.submit(kind, payload, priority)
+    except jobs.QueueFull as e:
+        return jsonify({"error": "Job queue is full", "detail": str(e)}), 503
+
+    logger.info(f"Queued {kind} job {job_id}")
+    return jsonify({
+        "job_id": job_id,
+        "status": jobs.QUEUED,
+        "status_url": f"/jobs/{job_id}",
+        "events_url": f"/jobs/{job_id}/events"
+    }), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Poll a job: status, result once done, and partial results after ?after=<next>"""
+    state = job_queue.get(job_id, request.args.get('after', 0, type=int))
+    if state is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+    return jsonify(state)
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Subscribe to a job: NDJSON partial results as they arrive, then a final status line"""
+    after = request.args.get('after', 0, type=int)
+    if job_queue.get(job_id, after) is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+
+    def generate():
+        for event in job_queue.follow(job_id, after):
+            yield json.dumps(event) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued job, or stop a running one at its next step"""
+    status = job_queue.cancel(job_id)
+    if status is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+    return jsonify({"job_id": job_id, "status": status})
 
-        # Search Last.fm
-        params = {
-            "method": "tag.gettoptracks",
-            "tag": search_query,
-            "api_key": LASTFM_API_KEY,
-            "limit": 3
-        }
-        response = requests.get("http://ws.audioscrobbler.com/2.0/", params=params)
-
-        if response.status_code == 200:
-            tracks = response.json().get('tracks', {}).get('track', [])
-            for track in tracks:
-                # Get YouTube link
-                yt_link = None
-                if yt:
-                    results = yt.search(f"{track['name']} {track['artist']['name']}")
-                    for item in results:
-                        if item["resultType"] == "video":
-                            yt_link = f"https://music.youtube.com/watch?v={item['videoId']}"
-                            break
-
-                recommendations.append({
-                    "track": track['name'],
-                    "artist": track['artist']['name'],
-                    "tag": tag,
-                    "yt_link": yt_link
-                })
-
-    return recommendations
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
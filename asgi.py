@@ -0,0 +1,501 @@
+import os
+import json
+import asyncio
+import logging
+import contextlib
+
+import anyio
+import httpx
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Mount, Route
+
+# Importing app loads .env and builds the Flask app that serves every route not defined here
+import app as flask_backend
+import metrics
+import ratelimit
+import http_client
+import recommender
+import spotify_api
+import emotion as emotion_detector
+from fanout import Deadline
+from singleflight import AsyncSingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Outbound connection pool for the async client, and threads for the sync LLM/YTMusic SDKs
+ASGI_HTTP_MAX_CONNECTIONS = int(os.getenv("ASGI_HTTP_MAX_CONNECTIONS", "200"))
+ASGI_THREADS = int(os.getenv("ASGI_THREADS", "64"))
+
+client = None
+
+# Async twins of the thread-side single-flight groups for calls made on the event loop
+profile_flight = AsyncSingleFlight("asgi_spotify_profile")
+lastfm_flight = AsyncSingleFlight("asgi_lastfm")
+
+
+async def send(method, url, retry=True, timeout=None, upstream=None, **kwargs):
+    """Send a request on the shared async client, retrying 429/5xx like http_client does.
+
+    Each attempt waits for the upstream's rate-limit budget when it has one.
+    """
+    limiter = ratelimit.limiter(upstream)
+    retries = http_client.HTTP_RETRIES if retry else 0
+    for attempt in range(retries + 1):
+        last_attempt = attempt == retries
+        if limiter is not None:
+            await limiter.acquire_async()
+        try:
+            response = await client.request(method, url, timeout=timeout or httpx.USE_CLIENT_DEFAULT, **kwargs)
+        except httpx.TransportError:
+            if last_attempt:
+                raise
+            await asyncio.sleep(http_client.backoff_delay(attempt))
+            continue
+
+        if response.status_code == 429 and limiter is not None:
+            await limiter.throttle_async(http_client.retry_after_seconds(response.headers))
+        if response.status_code not in http_client.RETRY_STATUSES or last_attempt:
+            return response
+
+        delay = http_client.backoff_delay(attempt)
+        if "Retry-After" in response.headers:
+            delay = http_client.retry_after_seconds(response.headers, delay)
+        await asyncio.sleep(delay)
+
+
+async def timed(stage, awaitable):
+    with metrics.span(stage):
+        return await awaitable
+
+
+async def read_json(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+async def get_profile(access_token):
+    """Async twin of spotify_api.get_profile; fetches profile and top artists concurrently"""
+    profile = spotify_api.cached_profile(access_token)
+    if profile is not None:
+        return profile
+
+    return await profile_flight.do(spotify_api.token_key(access_token), _fetch_profile, access_token)
+
+
+async def _fetch_profile(access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    profile_response, artists_response = await asyncio.gather(
+        timed("spotify_profile", send("GET", spotify_api.PROFILE_URL, upstream="spotify", headers=headers)),
+        timed("spotify_top_artists", send("GET", spotify_api.TOP_ARTISTS_URL, upstream="spotify",
+                                                headers=headers))
+    )
+
+    if profile_response.status_code != 200:
+        raise spotify_api.SpotifyError(profile_response.status_code, spotify_api.error_detail(profile_response))
+
+    top_artists = []
+    if artists_response.status_code == 200:
+        top_artists = artists_response.json().get("items", [])
+    else:
+        logger.warning(f"Spotify top artists error: {artists_response.status_code}")
+
+    profile = spotify_api.build_profile(profile_response.json(), top_artists)
+    if artists_response.status_code == 200:
+        spotify_api.cache_profile(access_token, profile)
+    return profile
+
+
+async def fetch_tag_tracks(tag, limit):
+    """Async twin of recommender.fetch_tag_tracks sharing its cache"""
+    cache_key = recommender.tag_cache_key(tag, limit)
+    cached = recommender.lastfm_cache.get_memory(cache_key)
+    if cached is None and recommender.lastfm_cache.disk is not None:
+        cached = await run_in_threadpool(recommender.lastfm_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    return await lastfm_flight.do(cache_key, _fetch_tag_tracks, tag, limit, cache_key)
+
+
+async def _fetch_tag_tracks(tag, limit, cache_key):
+    response = await timed("lastfm", send("GET", recommender.LASTFM_URL, params=recommender.tag_params(tag, limit),
+                                          timeout=recommender.LASTFM_TIMEOUT, upstream="lastfm"))
+    if response.status_code != 200:
+        logger.warning(f"Last.fm error for tag {tag}: {response.status_code}")
+        return []
+
+    tracks = recommender.parse_tag_tracks(tag, response.json())
+    if tracks is None:
+        return []
+
+    if recommender.lastfm_cache.disk is not None:
+        await run_in_threadpool(recommender.lastfm_cache.set, cache_key, tracks)
+    else:
+        recommender.lastfm_cache.set(cache_key, tracks)
+    return tracks
+
+
+async def resolve_yt_link(track, artist):
+    # Index hits in memory answer inline; the disk tier and real searches go to a worker thread
+    found, link = recommender.cached_yt_link(track, artist, memory_only=True)
+    if found:
+        return link
+    return await run_in_threadpool(recommender.resolve_yt_link, track, artist)
+
+
+async def recommendation_events(access_token, emotion, resolve=recommender.YT_RESOLVE_MODE, state=None):
+    """Async version of recommender.recommendation_events yielding the same events"""
+    recommender.check_resolve_mode(resolve)
+    deadline = Deadline(recommender.RECOMMENDATION_DEADLINE)
+
+    try:
+        profile = await get_profile(access_token)
+    except spotify_api.SpotifyError as e:
+        raise recommender.RecommendationError(e.status_code, "Failed to get user profile", e.detail)
+
+    pool = recommender.warm_pool(emotion)
+    if pool:
+        # Ranking, and remembering the round under the session's lock, happen off the event loop
+        for event in await run_in_threadpool(list, recommender.pool_events(pool, emotion, profile, state)):
+            yield event
+        return
+
+    country = profile['country']
+    genres = profile['genres']
+
+    tags = await run_in_threadpool(recommender.generate_tags, emotion, genres, country)
+    if not tags:
+        raise recommender.RecommendationError(500, "Failed to generate tags")
+
+    yield {"event": "tags", "tags": tags, "emotion": emotion, "genres": genres, "country": country}
+
+    selected_tags = tags[:recommender.TAGS_PER_REQUEST]
+    tag_tasks = [asyncio.create_task(fetch_tag_tracks(tag, recommender.RANK_CANDIDATES_PER_TAG))
+                 for tag in selected_tags]
+    done, pending = await asyncio.wait(tag_tasks, timeout=deadline.remaining())
+    if pending:
+        logger.warning(f"Deadline hit with {len(pending)} Last.fm lookups unfinished")
+        for task in pending:
+            task.cancel()
+
+    tag_tracks = []
+    for tag, task in zip(selected_tags, tag_tasks):
+        if task not in done:
+            tag_tracks.append([])
+        elif task.exception() is not None:
+            logger.warning(f"Last.fm lookup failed for tag {tag}: {task.exception()}")
+            tag_tracks.append([])
+        else:
+            tag_tracks.append(task.result())
+
+    # Ranking looks every candidate up in the index, which may read its disk tier
+    tracks = await run_in_threadpool(recommender.rank_candidates, selected_tags, tag_tracks, profile)
+    if not tracks:
+        raise recommender.RecommendationError(404, "No tracks found for these tags")
+    if state is not None:
+        # A feedback round may hold the state's lock; wait for it off the event loop
+        await run_in_threadpool(recommender.remember_round, state, emotion, profile, selected_tags, tag_tracks,
+                                tracks)
+
+    link_tasks = {}
+    for index, track in enumerate(tracks):
+        yield {"event": "track", "index": index, "track": track['track'], "artist": track['artist'],
+               "tag": track['tag']}
+        if (resolve == "eager" and index < recommender.YT_RESOLVE_LIMIT and 'yt_link' not in track
+                and recommender.search_enabled):
+            link_tasks[asyncio.create_task(resolve_yt_link(track['track'], track['artist']))] = index
+
+    for index, track in enumerate(tracks):
+        if track.get('yt_link'):
+            yield {"event": "yt_link", "index": index, "yt_link": track['yt_link']}
+
+    pending = set(link_tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=deadline.remaining(),
+                                           return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            logger.warning(f"Deadline hit with {len(pending)} YouTube lookups unfinished")
+            for task in pending:
+                task.cancel()
+            break
+
+        for task in done:
+            if task.exception() is not None:
+                logger.warning(f"YouTube lookup failed: {task.exception()}")
+            elif task.result():
+                yield {"event": "yt_link", "index": link_tasks[task], "yt_link": task.result()}
+
+    yield {"event": "done", "count": len(tracks)}
+
+
+async def request_access_token(body):
+    """Async twin of app.request_access_token; sessions are read from SQLite in a worker thread"""
+    session_id = body.get('session_id')
+    if not session_id:
+        return body.get('access_token')
+    return await run_in_threadpool(flask_backend.spotify_tokens.access_token, session_id)
+
+
+def recommendation_input(body):
+    if not body:
+        return {"error": "Missing request body"}
+    if 'access_token' not in body and 'session_id' not in body:
+        return {"error": "Missing access_token or session_id"}
+    if 'emotion' not in body:
+        return {"error": "Missing emotion"}
+    return None
+
+
+def token_error_response(e):
+    return JSONResponse({"error": "Failed to get Spotify token", "detail": e.detail}, status_code=e.status_code)
+
+
+def error_response(e):
+    body = {"error": e.error}
+    if e.detail:
+        body["detail"] = e.detail
+    return JSONResponse(body, status_code=e.status_code)
+
+
+async def detect_emotion(request):
+    body = await read_json(request)
+    if not body or 'text' not in body:
+        return JSONResponse({"error": "Missing text in request"}, status_code=400)
+
+    try:
+        emotion = await run_in_threadpool(emotion_detector.detect, body['text'])
+        logger.info(f"Detected emotion: {emotion}")
+        return JSONResponse({"emotion": emotion})
+    except Exception as e:
+        logger.error(f"Emotion detection error: {str(e)}")
+        return JSONResponse({"error": "Failed to detect emotion", "detail": str(e)}, status_code=500)
+
+
+async def get_spotify_token(request):
+    body = await read_json(request)
+    if not body or 'auth_code' not in body:
+        return JSONResponse({"error": "Missing auth_code in request"}, status_code=400)
+
+    try:
+        data = {
+            "grant_type": "authorization_code",
+            "code": body['auth_code'],
+            "redirect_uri": flask_backend.REDIRECT_URI,
+            "client_id": flask_backend.CLIENT_ID,
+            "client_secret": flask_backend.CLIENT_SECRET
+        }
+        # Authorization codes are single-use, so the exchange is never retried
+        response = await timed("spotify_token", send("POST", spotify_api.TOKEN_URL,
+                                                    retry=False, upstream="spotify", data=data))
+
+        if response.status_code != 200:
+            error_detail = response.json().get('error_description', 'No error details')
+            logger.error(f"Spotify API error: {response.status_code} - {error_detail}")
+            return JSONResponse({
+                "error": f"Spotify API error: {response.status_code}",
+                "detail": error_detail
+            }, status_code=response.status_code)
+
+        tokens = response.json()
+        session_id = flask_backend.spotify_tokens.create(tokens)
+        return JSONResponse({
+            "session_id": session_id,
+            # Deprecated: for clients that still call Spotify themselves; use session_id instead
+            "access_token": tokens.get("access_token"),
+            "expires_in": tokens.get("expires_in")
+        })
+
+    except Exception as e:
+        logger.error(f"Token exchange error: {str(e)}")
+        return JSONResponse({
+            "error": "Internal server error during token exchange",
+            "detail": str(e)
+        }, status_code=500)
+
+
+async def get_user_data(request):
+    body = await read_json(request)
+    if not body or ('access_token' not in body and 'session_id' not in body):
+        return JSONResponse({"error": "Missing access_token or session_id in request"}, status_code=400)
+
+    try:
+        return JSONResponse(await get_profile(await request_access_token(body)))
+    except spotify_api.SpotifyError as e:
+        return JSONResponse({
+            "error": f"Failed to get user profile: {e.status_code}",
+            "detail": e.detail
+        }, status_code=e.status_code)
+    except Exception as e:
+        logger.error(f"User data error: {str(e)}")
+        return JSONResponse({"error": "Failed to get user data", "detail": str(e)}, status_code=500)
+
+
+async def get_recommendations(request):
+    body = await read_json(request)
+    invalid = recommendation_input(body)
+    if invalid:
+        return JSONResponse(invalid, status_code=400)
+
+    logger.info(f"Starting recommendation process for emotion: {body['emotion']}")
+
+    try:
+        access_token = await request_access_token(body)
+    except spotify_api.SpotifyError as e:
+        return token_error_response(e)
+
+    try:
+        result = {"recommendations": []}
+        async for event in recommendation_events(access_token, body['emotion'],
+                                                    body.get('resolve', recommender.YT_RESOLVE_MODE),
+                                                    flask_backend.request_state(body)):
+            recommender.apply_event(result, event)
+        return JSONResponse(result)
+    except recommender.RecommendationError as e:
+        return error_response(e)
+    except Exception as e:
+        logger.error(f"Recommendation error: {str(e)}")
+        return JSONResponse({"error": "Internal server error", "detail": str(e)}, status_code=500)
+
+
+async def get_recommendations_stream(request):
+    body = await read_json(request)
+    invalid = recommendation_input(body)
+    if invalid:
+        return JSONResponse(invalid, status_code=400)
+
+    try:
+        access_token = await request_access_token(body)
+    except spotify_api.SpotifyError as e:
+        return token_error_response(e)
+
+    events = recommendation_events(access_token, body['emotion'], body.get('resolve', recommender.YT_RESOLVE_MODE),
+                                   flask_backend.request_state(body))
+
+    # Run up to the first event here so profile and tag failures keep their status codes
+    try:
+        first_event = await events.__anext__()
+    except recommender.RecommendationError as e:
+        return error_response(e)
+    except Exception as e:
+        logger.error(f"Recommendation error: {str(e)}")
+        return JSONResponse({"error": "Internal server error", "detail": str(e)}, status_code=500)
+
+    async def generate():
+        yield json.dumps(first_event) + "\n"
+        try:
+            async for event in events:
+                yield json.dumps(event) + "\n"
+        except recommender.RecommendationError as e:
+            yield json.dumps({"event": "error", "error": e.error, "status": e.status_code}) + "\n"
+        except Exception as e:
+            logger.error(f"Recommendation stream error: {str(e)}")
+            yield json.dumps({"event": "error", "error": "Internal server error", "detail": str(e)}) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson",
+                             headers={"X-Accel-Buffering": "no"})
+
+
+async def resolve_links(request):
+    body = await read_json(request)
+    invalid = flask_backend.resolve_input(body)
+    if invalid:
+        return JSONResponse({"error": invalid}, status_code=400)
+
+    deadline = Deadline(recommender.YT_RESOLVE_DEADLINE)
+    tasks = [asyncio.create_task(resolve_yt_link(track['track'], track.get('artist'))) for track in body['tracks']]
+    done = set()
+    if tasks:
+        done, pending = await asyncio.wait(tasks, timeout=deadline.remaining())
+        for task in pending:
+            task.cancel()
+
+    # False marks lookups cut off by the deadline, as in recommender.resolve_yt_links
+    links = []
+    for task in tasks:
+        if task not in done:
+            links.append(False)
+        elif task.exception() is not None:
+            logger.warning(f"YouTube lookup failed: {task.exception()}")
+            links.append(False)
+        else:
+            links.append(task.result())
+    return JSONResponse({
+        "yt_links": [link or None for link in links],
+        "unresolved": [index for index, link in enumerate(links) if link is False]
+    })
+
+
+class TracingMiddleware:
+    """Adds Server-Timing and request histograms for routes served natively here.
+
+    Requests that fall through to Flask already carry a Server-Timing header
+    from its own hooks and are left alone.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace = metrics.start_trace()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if "server-timing" not in headers:
+                    headers.append("Server-Timing", trace.server_timing())
+                    endpoint = scope.get("endpoint")
+                    metrics.request_seconds.observe(trace.elapsed(), status=message["status"],
+                                                    endpoint=getattr(endpoint, "__name__", "unknown"))
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global client
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ASGI_THREADS
+    # Native routes never reach Flask's first-request hook
+    flask_backend.start_background_services()
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=ASGI_HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=ASGI_HTTP_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(http_client.HTTP_READ_TIMEOUT, connect=http_client.HTTP_CONNECT_TIMEOUT)
+    )
+    yield
+    await client.aclose()
+
+
+# Hot I/O routes run natively on the event loop; everything else falls through to Flask
+app = Starlette(
+    routes=[
+        Route('/detect_emotion', detect_emotion, methods=['POST']),
+        Route('/get_spotify_token', get_spotify_token, methods=['POST']),
+        Route('/get_user_data', get_user_data, methods=['POST']),
+        Route('/get_recommendations', get_recommendations, methods=['POST']),
+        Route('/get_recommendations/stream', get_recommendations_stream, methods=['POST']),
+        Route('/resolve', resolve_links, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_backend.app, workers=ASGI_THREADS)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+        Middleware(TracingMiddleware)
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    uvicorn.run("asgi:app", host='0.0.0.0', port=5000, workers=int(os.getenv("ASGI_WORKERS", "1")))
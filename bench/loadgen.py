@@ -0,0 +1,225 @@
+"""Open-loop load generator for the backend.
+
+Requests are scheduled at a fixed rate regardless of how fast the backend
+answers, and latency is measured from each request's scheduled start, so a
+backed-up server shows up as latency rather than as a lower request rate.
+
+    python -m bench.loadgen --url http://127.0.0.1:5000 --rps 20 --duration 30 \
+        --save bench/results/latest.json --baseline bench/results/baseline.json
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# endpoint -> weight in the request mix
+DEFAULT_MIX = {
+    "detect_emotion": 4,
+    "get_recommendations": 3,
+    "process_feedback": 1,
+    "create_playlist": 2,
+}
+
+SAMPLE_TEXTS = [
+    "I finally got the job, can't stop smiling",
+    "Rainy sunday, everything feels slow and grey",
+    "Stuck in traffic again and I'm going to scream",
+    "Missing the summer nights with my old friends",
+    "Big exam tomorrow and I haven't slept",
+    "Just a calm evening with tea and a book",
+]
+SAMPLE_EMOTIONS = ["happy", "sad", "angry", "nostalgic", "anxious", "calm"]
+SAMPLE_FEEDBACK = ["too slow, give me something upbeat", "love this, more like it", "a bit too loud"]
+
+
+def make_request(session, base_url, endpoint, token, timeout):
+    """Send one request of the given kind; returns the HTTP status"""
+    if endpoint == "detect_emotion":
+        response = session.post(f"{base_url}/detect_emotion",
+                                json={"text": random.choice(SAMPLE_TEXTS)}, timeout=timeout)
+    elif endpoint == "get_recommendations":
+        response = session.post(f"{base_url}/get_recommendations",
+                                json={"access_token": token, "emotion": random.choice(SAMPLE_EMOTIONS)},
+                                timeout=timeout)
+    elif endpoint == "process_feedback":
+        response = session.post(f"{base_url}/process_feedback", json={
+            "access_token": token,
+            "feedback": random.choice(SAMPLE_FEEDBACK),
+            "current_mood": random.choice(SAMPLE_EMOTIONS),
+            "current_track": "Bench Song 0",
+            "current_tags": ["chill", "warm"]
+        }, timeout=timeout)
+    else:
+        size = random.randint(5, 30)
+        response = session.post(f"{base_url}/create_playlist", json={"recommendations": [
+            {"track": f"Bench Song {i}", "artist": f"Artist {i}",
+             "yt_link": f"https://music.youtube.com/watch?v=bench{i:06d}"}
+            for i in range(size)
+        ]}, timeout=timeout)
+    # Drain the body so streamed responses are timed to completion
+    response.content
+    return response.status_code
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+    """samples: [(latency seconds, ok)] -> latency percentiles (ms), throughput and error rate"""
+    latencies = sorted(latency for latency, _ in samples)
+    errors = sum(1 for _, ok in samples if not ok)
+    count = len(samples)
+    return {
+        "requests": count,
+        "errors": errors,
+        "error_rate": round(errors / count, 4) if count else 0.0,
+        "throughput_rps": round(count / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / count * 1000, 1) if count else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1) if count else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1) if count else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1) if count else None,
+    }
+
+
+def run(base_url, rps, duration, mix=None, users=10, timeout=60.0, max_in_flight=512):
+    """Drive the backend at a fixed request rate and return a summary per endpoint"""
+    mix = mix or DEFAULT_MIX
+    endpoints = list(mix)
+    weights = [mix[endpoint] for endpoint in endpoints]
+    tokens = [f"bench-user-{i}" for i in range(users)]
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    samples = {endpoint: [] for endpoint in endpoints}
+    samples_lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    dropped = 0
+
+    def fire(endpoint, token, scheduled_at):
+        try:
+            status = make_request(session, base_url, endpoint, token, timeout)
+            ok = status < 400
+        except requests.RequestException:
+            ok = False
+        finally:
+            in_flight.release()
+        latency = time.perf_counter() - scheduled_at
+        with samples_lock:
+            samples[endpoint].append((latency, ok))
+
+    total = int(rps * duration)
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for i in range(total):
+            scheduled_at = started_at + i / rps
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if not in_flight.acquire(blocking=False):
+                # Client saturated; count it as a failed request rather than slowing the schedule
+                dropped += 1
+                continue
+            endpoint = random.choices(endpoints, weights)[0]
+            executor.submit(fire, endpoint, random.choice(tokens), scheduled_at)
+    elapsed = time.perf_counter() - started_at
+
+    all_samples = [sample for endpoint_samples in samples.values() for sample in endpoint_samples]
+    all_samples += [(timeout, False)] * dropped
+    return {
+        "config": {"url": base_url, "rps": rps, "duration": duration, "mix": mix, "users": users},
+        "overall": summarize(all_samples, elapsed),
+        "endpoints": {endpoint: summarize(samples[endpoint], elapsed) for endpoint in endpoints},
+        "dropped": dropped,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Regressions beyond the tolerance (fraction) for latency percentiles and error rate"""
+    regressions = []
+    sections = [("overall", result["overall"], baseline.get("overall", {}))]
+    sections += [(endpoint, summary, baseline.get("endpoints", {}).get(endpoint, {}))
+                 for endpoint, summary in result["endpoints"].items()]
+
+    for name, current, previous in sections:
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if current.get(metric) is None or not previous.get(metric):
+                continue
+            if current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {previous[metric]} -> {current[metric]}")
+        if current.get("error_rate", 0) > previous.get("error_rate", 0) + tolerance / 10:
+            regressions.append(f"{name} error_rate: {previous.get('error_rate')} -> {current['error_rate']}")
+    return regressions
+
+
+def print_report(result):
+    columns = ("requests", "error_rate", "throughput_rps", "mean_ms", "p50_ms", "p95_ms", "p99_ms")
+    print(f"{'endpoint':<22}" + "".join(f"{column:>16}" for column in columns))
+    rows = list(result["endpoints"].items()) + [("overall", result["overall"])]
+    for name, summary in rows:
+        print(f"{name:<22}" + "".join(f"{str(summary[column]):>16}" for column in columns))
+    if result["dropped"]:
+        print(f"{result['dropped']} requests dropped at the client (too many in flight)")
+
+
+def parse_mix(spec):
+    """'detect_emotion=4,create_playlist=1' -> {endpoint: weight}"""
+    mix = {}
+    for part in spec.split(","):
+        endpoint, _, weight = part.partition("=")
+        if endpoint.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown endpoint: {endpoint}")
+        mix[endpoint.strip()] = float(weight or 1)
+    return mix
+
+
+def add_load_arguments(parser):
+    parser.add_argument("--rps", type=float, default=10.0, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--mix", type=parse_mix, help="endpoint weights, e.g. detect_emotion=4,create_playlist=1")
+    parser.add_argument("--users", type=int, default=10, help="distinct access tokens to cycle through")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--save", help="write the results as JSON to this path")
+    parser.add_argument("--baseline", help="compare against a saved result and exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fractional latency increase")
+
+
+def report(result, args):
+    """Print, save and compare a run; returns the process exit code"""
+    print_report(result)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Saved results to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive the backend at a fixed request rate")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    add_load_arguments(parser)
+    args = parser.parse_args()
+
+    result = run(args.url, args.rps, args.duration, args.mix, args.users, args.timeout)
+    sys.exit(report(result, args))
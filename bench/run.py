@@ -0,0 +1,109 @@
+"""Benchmark the backend end to end against local upstream stand-ins.
+
+Starts the stubs, launches the backend in a subprocess pointed at them, waits
+for it to come up and runs the load generator:
+
+    python -m bench.run --rps 20 --duration 30                # Flask, threaded
+    python -m bench.run --server asgi --rps 50 --duration 30  # uvicorn
+    python -m bench.run --latency llm=2000:0.4 --failures lastfm=0.05 --rate-limits yt=0.02
+
+Results are written to bench/results/<server>-<timestamp>.json. Pass
+--update-baseline to store the run as bench/results/baseline-<server>.json;
+later runs are compared against it and exit 1 when they regress.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import requests
+
+from bench import loadgen, stubs
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Upstream budgets for the run: far above what the stubs are asked for, so client-side pacing
+# doesn't shape the results. RATE_LIMIT_<NAME> set in the shell still wins.
+BENCH_RATE_LIMIT = "10000/10000"
+BENCH_UPSTREAMS = ("lastfm", "ytmusic", "ytsearch", "spotify", "llm")
+
+
+def backend_command(server, port):
+    if server == "asgi":
+        return [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+                "--log-level", "warning"]
+    return [sys.executable, "-c", f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+
+
+def wait_until_ready(base_url, process, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Backend exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Backend did not answer on {base_url} within {timeout}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the backend against local stubs")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--backend-log", help="write backend output to this file instead of discarding it")
+    stubs.add_behaviour_arguments(parser)
+    loadgen.add_load_arguments(parser)
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    baseline_path = os.path.join(RESULTS_DIR, f"baseline-{args.server}.json")
+    args.save = args.save or os.path.join(RESULTS_DIR, f"{args.server}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    if args.baseline is None and not args.update_baseline and os.path.exists(baseline_path):
+        args.baseline = baseline_path
+
+    stub_server, stub_url = stubs.start(behaviour=stubs.parse_behaviour(args))
+
+    # Point every upstream at the stubs and keep local state (index, label log, model) out of the run
+    env = dict(os.environ, **stubs.backend_env(stub_url))
+    env.update({
+        "SPOTIFY_CLIENT_ID": "bench",
+        "SPOTIFY_CLIENT_SECRET": "bench",
+        "LASTFM_API_KEY": "bench",
+        "LASTFM_CACHE_DB": "",
+        "YT_INDEX_DB": "",
+        "EMOTION_LABEL_LOG": "",
+        "EMOTION_MODEL_PATH": "",
+        "JOB_DB": "",
+        "SPOTIFY_SESSION_DB": "",
+        "RATE_LIMIT_DB": "",
+    })
+    for name in BENCH_UPSTREAMS:
+        env.setdefault(f"RATE_LIMIT_{name.upper()}", BENCH_RATE_LIMIT)
+    log = open(args.backend_log, "w") if args.backend_log else subprocess.DEVNULL
+    process = subprocess.Popen(backend_command(args.server, args.port), cwd=ROOT_DIR, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_until_ready(base_url, process)
+        print(f"Benchmarking {args.server} backend on {base_url} at {args.rps} rps for {args.duration}s")
+        result = loadgen.run(base_url, args.rps, args.duration, args.mix, args.users, args.timeout)
+        result["config"]["server"] = args.server
+        exit_code = loadgen.report(result, args)
+        if args.update_baseline:
+            with open(baseline_path, "w") as f:
+                json.dump(result, f, indent=2)
+            print(f"Updated baseline {baseline_path}")
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        stub_server.shutdown()
+
+    sys.exit(exit_code)
@@ -0,0 +1,236 @@
+"""Local stand-ins for Spotify, Last.fm, YouTube Music search and an LLM server.
+
+One threaded HTTP server answers for every upstream, routed by path prefix:
+
+    /spotify/...    Spotify Web API (/v1/me, /v1/me/top/artists)
+    /accounts/...   Spotify accounts (/api/token)
+    /lastfm/2.0/    Last.fm tag.gettoptracks
+    /yt/search      YouTube Music search, ytmusicapi result shape
+    /llm/v1/...     OpenAI-compatible chat completions
+
+Each upstream gets a lognormal latency (median ms, sigma), a 5xx failure
+rate and a 429 rate. Run standalone with `python -m bench.stubs`.
+"""
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+GENRES = ["indie pop", "lo-fi", "synthwave", "neo soul", "alt rock", "ambient", "k-pop", "jazz rap"]
+MOODS = ["happy", "sad", "calm", "angry", "anxious", "nostalgic", "excited", "lonely"]
+TAGS = ["chill", "melancholy", "upbeat", "dreamy", "energetic", "acoustic", "dark", "warm", "groovy"]
+
+
+@dataclass
+class Behaviour:
+    median_ms: float = 50.0
+    sigma: float = 0.5
+    failure_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+
+    def delay(self):
+        return random.lognormvariate(0, self.sigma) * self.median_ms / 1000.0
+
+
+DEFAULT_BEHAVIOUR = {
+    "spotify": Behaviour(80, 0.4),
+    "accounts": Behaviour(120, 0.4),
+    "lastfm": Behaviour(150, 0.6),
+    "yt": Behaviour(400, 0.6),
+    "llm": Behaviour(900, 0.3),
+}
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _pick(options, seed, count=1):
+    rng = random.Random(seed)
+    return rng.sample(options, count) if count > 1 else rng.choice(options)
+
+
+def spotify_response(path, query):
+    if path.startswith("/v1/me/top/artists"):
+        limit = int(query.get("limit", ["5"])[0])
+        return {"items": [
+            {"name": f"Artist {i}", "genres": _pick(GENRES, i, 2)} for i in range(limit)
+        ]}
+    if path.startswith("/v1/me"):
+        return {"id": "bench-user", "country": "US"}
+    return None
+
+
+def accounts_response(path, query):
+    if path.startswith("/api/token"):
+        return {"access_token": f"bench-{random.getrandbits(64):x}", "refresh_token": "bench-refresh",
+                "expires_in": 3600}
+    return None
+
+
+def lastfm_response(path, query):
+    tag = query.get("tag", [""])[0]
+    limit = int(query.get("limit", ["5"])[0])
+    return {"tracks": {"track": [
+        {"name": f"{tag.title()} Song {i}", "artist": {"name": f"Artist {int(_digest(tag)[:4], 16) % 50 + i}"}}
+        for i in range(limit)
+    ]}}
+
+
+def yt_response(path, query):
+    q = query.get("q", [""])[0]
+    return [{"resultType": "song", "videoId": None}, {"resultType": "video", "videoId": _digest(q)[:11]}]
+
+
+def llm_response(body):
+    system = body["messages"][0]["content"]
+    user = body["messages"][-1]["content"]
+    seed = _digest(user)
+    # Constrained requests name their schema; otherwise go by the prompt
+    schema = body.get("response_format", {}).get("json_schema", {}).get("name")
+
+    if schema == "tags" or (schema is None and '"tags"' in system):
+        content = json.dumps({"tags": _pick(TAGS, seed, 5)})
+    elif schema == "feedback" or (schema is None and "feedback" in system):
+        content = json.dumps({
+            "response": "Got it, switching things up!",
+            "mood_adjustment": _pick(["more_energetic", "more_calm", "no_change"], seed),
+            "new_tags": _pick(TAGS, seed, 3)
+        })
+    elif schema == "emotion_batch" or (schema is None and "numbered" in system):
+        numbers = re.findall(r"^(\d+)\. ", user, re.MULTILINE)
+        content = json.dumps({"labels": [_pick(MOODS, seed + n) for n in numbers]})
+    else:
+        content = json.dumps({"emotion": _pick(MOODS, seed)})
+
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    behaviour = DEFAULT_BEHAVIOUR
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, body=None):
+        url = urlparse(self.path)
+        service, _, rest = url.path.lstrip("/").partition("/")
+        rest = "/" + rest
+        query = parse_qs(url.query)
+        if body:
+            query.update(parse_qs(body.decode("utf-8", "replace")))
+
+        behaviour = self.behaviour.get(service)
+        if behaviour is None:
+            return self._reply(404, {"error": "unknown stub"})
+
+        time.sleep(behaviour.delay())
+        roll = random.random()
+        if roll < behaviour.rate_limit_rate:
+            return self._reply(429, {"error": "rate limited"}, {"Retry-After": "1"})
+        if roll < behaviour.rate_limit_rate + behaviour.failure_rate:
+            return self._reply(503, {"error": "stub failure"})
+
+        if service == "spotify":
+            result = spotify_response(rest, query)
+        elif service == "accounts":
+            result = accounts_response(rest, query)
+        elif service == "lastfm":
+            result = lastfm_response(rest, query)
+        elif service == "yt":
+            result = yt_response(rest, query)
+        else:
+            result = llm_response(json.loads(body or b"{}"))
+
+        if result is None:
+            return self._reply(404, {"error": "unknown path"})
+        self._reply(200, result)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self._handle(self.rfile.read(length))
+
+
+def start(port=0, behaviour=None):
+    """Start the stub server on a background thread; returns (server, base_url)"""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"behaviour": behaviour or DEFAULT_BEHAVIOUR})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-stubs", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def backend_env(base_url):
+    """Environment that points the backend at the stubs"""
+    return {
+        "SPOTIFY_API_URL": f"{base_url}/spotify",
+        "SPOTIFY_ACCOUNTS_URL": f"{base_url}/accounts",
+        "LASTFM_URL": f"{base_url}/lastfm/2.0/",
+        "YT_SEARCH_URL": f"{base_url}/yt/search",
+        "LLM_OPENAI_URL": f"{base_url}/llm/v1",
+    }
+
+
+def parse_behaviour(args):
+    """Apply --latency svc=median_ms[:sigma], --failures svc=rate, --rate-limits svc=rate"""
+    behaviour = {name: Behaviour(**vars(b)) for name, b in DEFAULT_BEHAVIOUR.items()}
+    for spec in args.latency or []:
+        name, _, value = spec.partition("=")
+        median, _, sigma = value.partition(":")
+        behaviour[name].median_ms = float(median)
+        if sigma:
+            behaviour[name].sigma = float(sigma)
+    for spec in args.failures or []:
+        name, _, value = spec.partition("=")
+        behaviour[name].failure_rate = float(value)
+    for spec in args.rate_limits or []:
+        name, _, value = spec.partition("=")
+        behaviour[name].rate_limit_rate = float(value)
+    return behaviour
+
+
+def add_behaviour_arguments(parser):
+    parser.add_argument("--latency", action="append", metavar="SVC=MS[:SIGMA]",
+                        help="median latency and lognormal sigma for an upstream")
+    parser.add_argument("--failures", action="append", metavar="SVC=RATE", help="fraction of 503 answers")
+    parser.add_argument("--rate-limits", action="append", metavar="SVC=RATE", help="fraction of 429 answers")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run the upstream stand-ins")
+    parser.add_argument("--port", type=int, default=8700)
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = start(args.port, parse_behaviour(args))
+    print(f"Stubs listening on {base_url}")
+    for name, value in backend_env(base_url).items():
+        print(f"export {name}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,207 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe in-memory LRU cache with per-entry expiry"""
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+class SQLiteStore:
+    """On-disk key/value tier with expiry that survives restarts"""
+
+    def __init__(self, path, table="cache"):
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return (value, expires_at) for a live entry, or default"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or row[1] <= time.time():
+                if row is not None:
+                    self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return json.loads(row[0]), row[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl)
+            )
+
+    def set_many(self, items, ttl):
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                [(key, json.dumps(value), expires_at) for key, value in items]
+            )
+            self._conn.execute("COMMIT")
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def purge_expired(self):
+        with self._lock:
+            cursor = self._conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),))
+            return cursor.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self):
+        return {"path": self.path, "size": len(self), "hits": self.hits, "misses": self.misses}
+
+
+class TieredCache:
+    """In-memory LRU tier in front of an optional SQLite tier.
+
+    Keys are tuples; values must be JSON-serializable when a disk tier is set.
+    Disk hits are promoted into memory with their remaining lifetime.
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600, path=None, disk_ttl=None, table="cache"):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.disk = SQLiteStore(path, table=table) if path else None
+        self.disk_ttl = disk_ttl or ttl
+
+    @staticmethod
+    def _disk_key(key):
+        return json.dumps(key, separators=(",", ":"))
+
+    def get(self, key, default=None):
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        if self.disk is not None:
+            entry = self.disk.get(self._disk_key(key))
+            if entry is not None:
+                value, expires_at = entry
+                self.memory.set(key, value, ttl=min(self.memory.ttl, expires_at - time.time()))
+                return value
+
+        return default
+
+    def get_memory(self, key, default=None):
+        """Look in the memory tier only; never touches disk, so it is safe on an event loop"""
+        return self.memory.get(key, default)
+
+    def set(self, key, value, ttl=None, disk_ttl=None):
+        self.memory.set(key, value, ttl=ttl)
+        if self.disk is not None:
+            try:
+                self.disk.set(self._disk_key(key), value, disk_ttl or self.disk_ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"Cache disk write failed: {str(e)}")
+
+    def set_many(self, items, ttl=None, disk_ttl=None):
+        # Bulk loads go straight to disk when there is one, so they don't
+        # flush the hot entries out of the memory tier
+        if self.disk is None:
+            for key, value in items:
+                self.memory.set(key, value, ttl=ttl)
+            return
+
+        self.disk.set_many(
+            [(self._disk_key(key), value) for key, value in items],
+            disk_ttl or self.disk_ttl
+        )
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(self._disk_key(key))
+
+    def stats(self):
+        stats = {"memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
@@ -0,0 +1,134 @@
+import re
+import json
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import llm
+import metrics
+from emotion_classifier import LocalTier
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = ("You are an emotion detection expert. "
+                 'Respond ONLY with JSON of the form {"emotion": "label"}')
+EMOTION_SCHEMA = {
+    "type": "object",
+    "properties": {"emotion": {"type": "string", "minLength": 1}},
+    "required": ["emotion"]
+}
+
+BATCH_SYSTEM_PROMPT = ("You are an emotion detection expert. "
+                       'Respond ONLY with JSON of the form {"labels": ["label", ...]} '
+                       "holding one label per numbered text, in order.")
+
+# Local hashed-feature model that answers confident cases before the LLM
+local_tier = LocalTier()
+
+_BATCH_LINE = re.compile(r"^\s*\[?(\d+)\]?\s*[.:)\-]\s*(?:emotion\s*:\s*)?(.+?)\s*$", re.IGNORECASE)
+
+
+def parse_label(response):
+    return response.split(':')[-1].strip().lower()
+
+
+def parse_batch_lines(response, count):
+    """Labels from "<number>: label" lines, None where an item is missing"""
+    labels = [None] * count
+    for line in response.splitlines():
+        match = _BATCH_LINE.match(line)
+        if match and 1 <= int(match.group(1)) <= count:
+            labels[int(match.group(1)) - 1] = match.group(2)
+    return labels
+
+
+def detect(text):
+    """Detect the emotion label for one text, asking the LLM only when the local model is unsure"""
+    with metrics.span("emotion_local"):
+        label = local_tier.predict(text)
+    if label:
+        return label
+
+    with metrics.span("llm_emotion"):
+        result = llm.complete_json(
+            SYSTEM_PROMPT,
+            f"Detect the sentiment emotions with around maximum of 5 labels in this text: \"{text}\"",
+            EMOTION_SCHEMA, "emotion",
+            fallback=lambda content: {"emotion": parse_label(content)},
+            # Only fresh answers become training data; cached repeats would skew it
+            on_inference=lambda value: local_tier.record(text, parse_label(value["emotion"])))
+    return parse_label(result["emotion"])
+
+
+def detect_many(texts):
+    """Detect labels for several texts packed into one LLM prompt.
+
+    Texts the local model is confident about never reach the LLM, and items
+    the model leaves out of its answer are retried one by one.
+    """
+    labels = [local_tier.predict(text) for text in texts]
+    pending = [i for i, label in enumerate(labels) if not label]
+    if not pending:
+        return labels
+
+    pending_texts = [texts[i] for i in pending]
+    labels_for_pending = _ask_llm_many(pending_texts)
+    for i, label in zip(pending, labels_for_pending):
+        labels[i] = label
+    return labels
+
+
+def record_labels(texts, labels):
+    for text, label in zip(texts, labels):
+        local_tier.record(text, parse_label(label) if label else None)
+
+
+def _ask_llm_many(texts):
+    numbered = "\n".join(f"{i}. {json.dumps(text, ensure_ascii=False)}" for i, text in enumerate(texts, 1))
+    schema = {
+        "type": "object",
+        "properties": {"labels": {"type": "array", "items": {"type": "string"},
+                                  "minItems": len(texts), "maxItems": len(texts)}},
+        "required": ["labels"]
+    }
+    with metrics.span("llm_emotion_batch"):
+        result = llm.complete_json(
+            BATCH_SYSTEM_PROMPT,
+            "Detect the sentiment emotions with around maximum of 5 labels "
+            f"for each of these {len(texts)} texts:\n{numbered}",
+            schema, "emotion_batch",
+            fallback=lambda content: {"labels": parse_batch_lines(content, len(texts))},
+            on_inference=lambda value: record_labels(texts, value["labels"]))
+
+    labels = [parse_label(label) if label else None for label in result["labels"]]
+
+    missing = [i for i, label in enumerate(labels) if not label]
+    if missing:
+        logger.warning(f"Batch response missed {len(missing)} of {len(texts)} items, retrying singly")
+        for i in missing:
+            labels[i] = detect(texts[i])
+    return labels
+
+
+def detect_batch(texts, chunk_size, concurrency):
+    """Classify texts in chunks on a worker pool, yielding results as chunks finish.
+
+    Yields (start, labels, error) where start is the index of the chunk's first
+    text; on failure labels is all None and error holds the message.
+    """
+    chunks = {start: texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)}
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="emotion-batch")
+    try:
+        futures = {
+            executor.submit(contextvars.copy_context().run, detect_many, chunk): start
+            for start, chunk in chunks.items()
+        }
+        for future in as_completed(futures):
+            start = futures[future]
+            try:
+                yield start, future.result(), None
+            except Exception as e:
+                logger.error(f"Emotion batch chunk at {start} failed: {str(e)}")
+                yield start, [None] * len(chunks[start]), str(e)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import logging
+import argparse
+import threading
+from collections import Counter
+
+import numpy as np
+
+from caching import TTLCache
+
+logger = logging.getLogger(__name__)
+
+EMOTION_MODEL_PATH = os.getenv("EMOTION_MODEL_PATH", "emotion_model.npz")
+# LLM labels for retraining hold raw user text, so logging them is opt-in: set a file path to enable.
+# Past EMOTION_LABEL_LOG_MAX_BYTES the log is rotated to <path>.1, replacing the previous one.
+EMOTION_LABEL_LOG = os.getenv("EMOTION_LABEL_LOG", "")
+EMOTION_LABEL_LOG_MAX_BYTES = int(os.getenv("EMOTION_LABEL_LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+# Texts already logged are remembered this long, so repeats don't dominate the training data
+LABEL_DEDUP_SIZE = 100000
+LABEL_DEDUP_TTL = 7 * 86400
+# Minimum softmax probability for the local model to answer without the LLM
+EMOTION_LOCAL_THRESHOLD = float(os.getenv("EMOTION_LOCAL_THRESHOLD", "0.85"))
+EMOTION_MODEL_FEATURES = 2 ** 16
+MODEL_RELOAD_INTERVAL = 30
+
+_TOKEN = re.compile(r"[a-z0-9']+")
+
+
+def featurize(text, n_features=EMOTION_MODEL_FEATURES):
+    """Hash unigrams and bigrams into unique feature indices"""
+    tokens = _TOKEN.findall(text.lower())
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    if not grams:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique([zlib.crc32(gram.encode("utf-8")) % n_features for gram in grams])
+
+
+def _softmax(z):
+    z = np.exp(z - z.max())
+    return z / z.sum()
+
+
+class HashedLinearClassifier:
+    """Multinomial logistic regression over hashed n-gram features"""
+
+    def __init__(self, weights, bias, classes):
+        self.weights = weights  # (n_features, n_classes)
+        self.bias = bias
+        self.classes = list(classes)
+        self.n_features = weights.shape[0]
+
+    @classmethod
+    def train(cls, texts, labels, n_features=EMOTION_MODEL_FEATURES, epochs=10, lr=0.5, l2=1e-5, seed=0):
+        classes = sorted(set(labels))
+        class_index = {label: i for i, label in enumerate(classes)}
+        targets = np.array([class_index[label] for label in labels])
+        features = [featurize(text, n_features) for text in texts]
+
+        weights = np.zeros((n_features, len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        for _ in range(epochs):
+            for i in rng.permutation(len(texts)):
+                idx = features[i]
+                if not len(idx):
+                    continue
+                scale = 1.0 / np.sqrt(len(idx))
+                grad = _softmax(weights[idx].sum(axis=0) * scale + bias)
+                grad[targets[i]] -= 1.0
+                weights[idx] -= lr * (scale * grad + l2 * weights[idx])
+                bias -= lr * grad
+
+        return cls(weights, bias, classes)
+
+    def predict(self, text):
+        """Return (label, probability) for the most likely class"""
+        idx = featurize(text, self.n_features)
+        if not len(idx):
+            return None, 0.0
+        probs = _softmax(self.weights[idx].sum(axis=0) / np.sqrt(len(idx)) + self.bias)
+        best = int(probs.argmax())
+        return self.classes[best], float(probs[best])
+
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, classes=np.array(self.classes))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["weights"], data["bias"], data["classes"].tolist())
+
+
+class LocalTier:
+    """Answers confident cases locally and logs LLM labels for retraining.
+
+    The model file is reloaded when it changes, so a retrain picks up
+    without restarting the server.
+    """
+
+    def __init__(self, model_path=EMOTION_MODEL_PATH, log_path=EMOTION_LABEL_LOG,
+                 threshold=EMOTION_LOCAL_THRESHOLD, log_max_bytes=EMOTION_LABEL_LOG_MAX_BYTES):
+        self.model_path = model_path
+        self.log_path = log_path
+        self.threshold = threshold
+        self.log_max_bytes = log_max_bytes
+        self._logged = TTLCache(maxsize=LABEL_DEDUP_SIZE, ttl=LABEL_DEDUP_TTL)
+        self.model = None
+        self._model_mtime = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.fallbacks = 0
+        self.labels_logged = 0
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < MODEL_RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.model_path)
+        except OSError:
+            return
+        if mtime != self._model_mtime:
+            try:
+                self.model = HashedLinearClassifier.load(self.model_path)
+                self._model_mtime = mtime
+                logger.info(f"Loaded local emotion model with {len(self.model.classes)} labels")
+            except Exception as e:
+                logger.error(f"Failed to load local emotion model: {str(e)}")
+
+    def predict(self, text):
+        """Return a label when the local model is confident, else None"""
+        if self.model_path:
+            self._maybe_reload()
+        model = self.model
+        if model is not None:
+            label, confidence = model.predict(text)
+            if label is not None and confidence >= self.threshold:
+                self.local_hits += 1
+                return label
+        self.fallbacks += 1
+        return None
+
+    def record(self, text, label):
+        """Append an LLM-assigned label to the training log, once per distinct text"""
+        if not self.log_path or not label:
+            return
+        digest = hashlib.sha256(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+        line = json.dumps({"text": text, "label": label}, ensure_ascii=False)
+        with self._lock:
+            if self._logged.get(digest):
+                return
+            try:
+                if os.path.exists(self.log_path) and os.path.getsize(self.log_path) >= self.log_max_bytes:
+                    os.replace(self.log_path, self.log_path + ".1")
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                logger.warning(f"Failed to log emotion label: {str(e)}")
+                return
+            self._logged.set(digest, True)
+            self.labels_logged += 1
+
+    def stats(self):
+        total = self.local_hits + self.fallbacks
+        return {
+            "model_loaded": self.model is not None,
+            "threshold": self.threshold,
+            "local_hits": self.local_hits,
+            "llm_fallbacks": self.fallbacks,
+            "labels_logged": self.labels_logged,
+            "local_ratio": round(self.local_hits / total, 4) if total else 0.0
+        }
+
+
+def load_labels(log_path, min_count=5):
+    """Read logged (text, label) pairs, rotated file included, keeping labels seen at least min_count times"""
+    texts, labels = [], []
+    for path in (log_path + ".1", log_path):
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                if row.get("text") and row.get("label"):
+                    texts.append(row["text"])
+                    labels.append(row["label"])
+
+    counts = Counter(labels)
+    kept = [(text, label) for text, label in zip(texts, labels) if counts[label] >= min_count]
+    return [text for text, _ in kept], [label for _, label in kept]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Train the local emotion model from logged LLM labels")
+    parser.add_argument("--log", default=EMOTION_LABEL_LOG or "emotion_labels.jsonl",
+                        help="JSON Lines file of text/label pairs")
+    parser.add_argument("--out", default=EMOTION_MODEL_PATH, help="where to write the model")
+    parser.add_argument("--min-count", type=int, default=5, help="drop labels seen fewer times")
+    parser.add_argument("--epochs", type=int, default=10)
+    args = parser.parse_args()
+
+    texts, labels = load_labels(args.log, args.min_count)
+    if len(set(labels)) < 2:
+        parser.error("need at least two labels with enough examples to train")
+
+    model = HashedLinearClassifier.train(texts, labels, epochs=args.epochs)
+    correct = sum(model.predict(text)[0] == label for text, label in zip(texts, labels))
+    logger.info(f"Trained on {len(texts)} examples, {len(model.classes)} labels, "
+                f"training accuracy {correct / len(texts):.3f}")
+
+    # Write then rename so a running server never loads a half-written file
+    tmp_path = args.out + ".tmp.npz"
+    model.save(tmp_path)
+    os.replace(tmp_path, args.out)
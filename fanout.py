@@ -0,0 +1,102 @@
+import os
+import time
+import logging
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Shared pool for outbound calls; bounds concurrency across all requests
+FANOUT_MAX_WORKERS = int(os.getenv("FANOUT_MAX_WORKERS", "16"))
+
+# Separate, smaller pool for work marked ratelimit.background(), so a pool build blocked on
+# upstream budget never queues ahead of interactive calls
+FANOUT_BACKGROUND_WORKERS = int(os.getenv("FANOUT_BACKGROUND_WORKERS", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix="fanout")
+_background_executor = ThreadPoolExecutor(max_workers=FANOUT_BACKGROUND_WORKERS,
+                                          thread_name_prefix="fanout-background")
+
+
+def _executor_for_caller():
+    return _background_executor if ratelimit.is_background() else _executor
+
+
+class Deadline:
+    """Wall-clock budget shared by every stage of one request"""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def fan_out(fn, items, deadline=None, default=None):
+    """Run fn over items concurrently and return the results in input order.
+
+    Calls that raise, or that are still running when the deadline passes,
+    yield `default` instead so callers can return partial results.
+    """
+    items = list(items)
+    if not items:
+        return []
+    if deadline is not None and deadline.expired:
+        logger.warning(f"Deadline already passed, skipping {len(items)} calls")
+        return [default] * len(items)
+
+    # Copy the caller's context so request tracing follows the call into the pool
+    executor = _executor_for_caller()
+    futures = [executor.submit(contextvars.copy_context().run, fn, item) for item in items]
+    done, not_done = wait(futures, timeout=deadline.remaining() if deadline else None)
+
+    if not_done:
+        logger.warning(f"Deadline hit with {len(not_done)} of {len(futures)} calls unfinished")
+        for future in not_done:
+            future.cancel()
+
+    results = []
+    for item, future in zip(items, futures):
+        if future not in done:
+            results.append(default)
+        elif future.exception() is not None:
+            logger.warning(f"Fan-out call failed for {item!r}: {future.exception()}")
+            results.append(default)
+        else:
+            results.append(future.result())
+    return results
+
+
+def submit(fn, *args, **kwargs):
+    """Schedule one call on the shared pool, carrying over the caller's context"""
+    return _executor_for_caller().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def iter_completed(futures, deadline=None):
+    """Yield (key, result) from a {key: future} dict as calls finish.
+
+    Failed calls are logged and skipped; anything still running when the
+    deadline passes is cancelled.
+    """
+    pending = {future: key for key, future in futures.items()}
+    while pending:
+        done, _ = wait(pending, timeout=deadline.remaining() if deadline else None,
+                       return_when=FIRST_COMPLETED)
+        if not done:
+            logger.warning(f"Deadline hit with {len(pending)} calls unfinished")
+            for future in pending:
+                future.cancel()
+            return
+
+        for future in done:
+            key = pending.pop(future)
+            if future.exception() is not None:
+                logger.warning(f"Call failed for {key!r}: {future.exception()}")
+                continue
+            yield key, future.result()
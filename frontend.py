@@ -1,13 +1,34 @@
 import streamlit as st
-import requests
 import os
+import html
+import json
+import hashlib
 from dotenv import load_dotenv
 import streamlit.components.v1 as components
 
+import http_client
+from caching import TTLCache
+
 load_dotenv()
 
 # Backend URL
 BACKEND_URL = "http://localhost:5000"
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", "60"))
+
+# Shared keep-alive session; the module is imported once, so it survives reruns
+backend = http_client.session("backend", read_timeout=BACKEND_TIMEOUT)
+
+# Backend answers are reused across reruns for this long (seconds), keyed on the request inputs
+EMOTION_CACHE_TTL = float(os.getenv("EMOTION_CACHE_TTL", "600"))
+RECOMMENDATION_CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", "300"))
+PLAYER_CACHE_ENTRIES = 16
+
+# With PLAYER_BACKEND_URL set to a backend address the browser can reach, playlists arrive without
+# YouTube links and the player resolves the next N tracks while one plays. Without it the
+# backend resolves every link before the player is built.
+PLAYER_PREFETCH = int(os.getenv("PLAYER_PREFETCH", "2"))
+PLAYER_BACKEND_URL = os.getenv("PLAYER_BACKEND_URL")
+PLAYER_RESOLVE = "lazy" if PLAYER_BACKEND_URL else "eager"
 
 # Initialize session state
 if "messages" not in st.session_state:
@@ -28,8 +49,9 @@ if "recommendations" not in st.session_state:
 if "spotify_authenticated" not in st.session_state:
     st.session_state.spotify_authenticated = False
 
-if "spotify_token" not in st.session_state:
-    st.session_state.spotify_token = None
+# Opaque backend session id; the backend keeps the Spotify tokens and refreshes them
+if "spotify_session" not in st.session_state:
+    st.session_state.spotify_session = None
 
 if "current_track_index" not in st.session_state:
     st.session_state.current_track_index = 0
@@ -56,6 +78,10 @@ def inject_custom_css():
             background-color: #e3f2fd;
             font-weight: bold;
         }
+        .track-item.unavailable {
+            color: #999;
+            text-decoration: line-through;
+        }
         .player-container {
             margin-top: 20px;
             border: 1px solid #ddd;
@@ -72,20 +98,52 @@ def inject_custom_css():
     """, unsafe_allow_html=True)
 
 
+# Stable key for a playlist, so unchanged playlists reuse the same player HTML
+def playlist_key(tracks):
+    # False marks links not looked up yet, None links looked up and not found
+    entries = [(track['artist'], track['track'], track.get('yt_link', False)) for track in tracks]
+    return hashlib.sha256(json.dumps(entries).encode("utf-8")).hexdigest()
+
+
+# Player HTML is built once per playlist; identical HTML also keeps the iframe from reloading on reruns
+@st.cache_data(max_entries=PLAYER_CACHE_ENTRIES, show_spinner=False)
+def cached_player_html(key, _tracks):
+    return create_music_player(_tracks)
+
+
+def video_id(link):
+    return link.split('=')[-1] if link else None
+
+
 # Create the music player component
 def create_music_player(tracks):
-    # Filter tracks with YouTube links
-    yt_tracks = [track for track in tracks if 'yt_link' in track]
+    # Tracks looked up and known to have no video are left out
+    tracks = [track for track in tracks if track.get('yt_link', False) is not None]
 
-    if not yt_tracks:
+    if not tracks:
         return "<div>No playable tracks found</div>"
 
+    track_items = "".join(
+        f'<div class="track-item{" playing" if i == 0 else ""}" onclick="playTrack({i})" id="track-{i}">'
+        f"{html.escape(str(track['artist']))} - {html.escape(str(track['track']))}</div>\n"
+        for i, track in enumerate(tracks)
+    )
+    # Unresolved tracks carry no "id" until the player resolves them.
+    # Escape "</" so a track title can't close the script block
+    tracks_js = json.dumps([
+        {'track': track['track'], 'artist': track['artist'], 'title': f"{track['artist']} - {track['track']}",
+         **({'id': video_id(track['yt_link'])} if 'yt_link' in track else {})}
+        for track in tracks
+    ]).replace("</", "<\\/")
+    first = tracks[0]
+    first_id = video_id(first.get('yt_link')) or ""
+
     # Generate HTML/JS for the player
     player_html = f"""
     <div class="player-container">
         <h3>🎵 Music Player</h3>
-        <div id="now-playing">Now Playing: {yt_tracks[0]['artist']} - {yt_tracks[0]['track']}</div>
-        <iframe id="yt-player" width="100%" height="200" src="https://www.youtube.com/embed/{yt_tracks[0]['yt_link'].split('=')[-1]}?enablejsapi=1&autoplay=1" frameborder="0" allow="accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture" allowfullscreen></iframe>
+        <div id="now-playing">Now Playing: {html.escape(str(first['artist']))} - {html.escape(str(first['track']))}</div>
+        <iframe id="yt-player" width="100%" height="200" src="https://www.youtube.com/embed/{first_id}?enablejsapi=1&autoplay=1" frameborder="0" allow="accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture" allowfullscreen></iframe>
 
         <div class="player-controls">
             <button onclick="playPrevious()">⏮ Previous</button>
@@ -95,19 +153,17 @@ def create_music_player(tracks):
 
         <div style="max-height: 300px; overflow-y: auto; margin-top: 15px;">
             <h4>Playlist</h4>
-            {"".join([f"""
-            <div class="track-item {'playing' if i == 0 else ''}" 
-                 onclick="playTrack({i})" 
-                 id="track-{i}">
-                {track['artist']} - {track['track']}
-            </div>
-            """ for i, track in enumerate(yt_tracks)])}
+            {track_items}
         </div>
     </div>
 
     <script>
-        var tracks = {[{'id': track['yt_link'].split('=')[-1], 'title': f"{track['artist']} - {track['track']}"} for track in yt_tracks]};
+        var tracks = {tracks_js};
+        var resolveUrl = {json.dumps(PLAYER_BACKEND_URL + "/resolve" if PLAYER_BACKEND_URL else None)};
+        var prefetchCount = {PLAYER_PREFETCH};
         var currentTrackIndex = 0;
+        var direction = 1;
+        var pending = {{}};
         var player;
 
         // Inject YouTube API script
@@ -126,7 +182,12 @@ def create_music_player(tracks):
         }}
 
         function onPlayerReady(event) {{
-            event.target.playVideo();
+            if (tracks[0].id) {{
+                event.target.playVideo();
+                prefetch(0);
+            }} else {{
+                playTrack(0);
+            }}
         }}
 
         function onPlayerStateChange(event) {{
@@ -135,21 +196,79 @@ def create_music_player(tracks):
             }}
         }}
 
-        function playTrack(index) {{
+        // Look up links for tracks that have none yet, in one batch; resolves once they are known
+        function resolveTracks(indexes) {{
+            var waiting = indexes.filter(i => pending[i]).map(i => pending[i]);
+            var missing = indexes.filter(i => tracks[i].id === undefined && !pending[i]);
+            if (missing.length && resolveUrl) {{
+                var request = fetch(resolveUrl, {{
+                    method: 'POST',
+                    headers: {{'Content-Type': 'application/json'}},
+                    body: JSON.stringify({{tracks: missing.map(i => ({{track: tracks[i].track, artist: tracks[i].artist}}))}})
+                }}).then(response => {{
+                    if (!response.ok) {{
+                        throw new Error('resolve failed with ' + response.status);
+                    }}
+                    return response.json();
+                }}).then(data => {{
+                    missing.forEach((i, j) => {{
+                        // Lookups that ran out of time stay unresolved and are retried later
+                        if (data.unresolved.indexOf(j) < 0) {{
+                            tracks[i].id = data.yt_links[j] ? data.yt_links[j].split('=').pop() : null;
+                        }}
+                    }});
+                }}).catch(error => {{
+                    // Failed lookups stay unresolved: playback skips them now and retries next time round
+                    console.warn('Link lookup failed', error);
+                }}).finally(() => {{
+                    missing.forEach(i => delete pending[i]);
+                }});
+                missing.forEach(i => pending[i] = request);
+                waiting.push(request);
+            }}
+            return Promise.all(waiting);
+        }}
+
+        // Resolve the next few tracks in the background while this one plays
+        function prefetch(index) {{
+            var upcoming = [];
+            for (var step = 1; step <= prefetchCount && step < tracks.length; step++) {{
+                upcoming.push((index + step) % tracks.length);
+            }}
+            resolveTracks(upcoming);
+        }}
+
+        function playTrack(index, skipped) {{
+            skipped = skipped || 0;
             currentTrackIndex = index;
-            player.loadVideoById(tracks[index].id);
             document.getElementById('now-playing').innerText = "Now Playing: " + tracks[index].title;
             updateTrackDisplay();
+
+            resolveTracks([index]).then(() => {{
+                if (currentTrackIndex != index) {{
+                    return;  // the listener moved on while this one resolved
+                }}
+                if (tracks[index].id) {{
+                    player.loadVideoById(tracks[index].id);
+                    prefetch(index);
+                }} else if (skipped < tracks.length) {{
+                    // null: no video exists; undefined: the lookup failed or ran out of time
+                    if (tracks[index].id === null) {{
+                        document.getElementById('track-' + index).classList.add('unavailable');
+                    }}
+                    playTrack((index + direction + tracks.length) % tracks.length, skipped + 1);
+                }}
+            }});
         }}
 
         function playNext() {{
-            currentTrackIndex = (currentTrackIndex + 1) % tracks.length;
-            playTrack(currentTrackIndex);
+            direction = 1;
+            playTrack((currentTrackIndex + 1) % tracks.length);
         }}
 
         function playPrevious() {{
-            currentTrackIndex = (currentTrackIndex - 1 + tracks.length) % tracks.length;
-            playTrack(currentTrackIndex);
+            direction = -1;
+            playTrack((currentTrackIndex - 1 + tracks.length) % tracks.length);
         }}
 
         function togglePlay() {{
@@ -174,6 +293,100 @@ def create_music_player(tracks):
     return player_html
 
 
+# Render the playlist as it builds up from the streamed recommendation events
+def render_progress(tags, recommendations):
+    lines = [f"**Tags:** {', '.join(tags)}", ""] if tags else []
+    for i, track in enumerate(recommendations, 1):
+        suffix = " 🎵" if track.get('yt_link') else ""
+        lines.append(f"{i}. {track['artist']} - {track['track']}{suffix}")
+    return "\n".join(lines)
+
+
+# Same text, same answer: skip the backend round-trip on repeats
+@st.cache_data(ttl=EMOTION_CACHE_TTL, show_spinner=False)
+def detect_emotion(text):
+    response = backend.post(f"{BACKEND_URL}/detect_emotion", json={"text": text})
+    response.raise_for_status()
+    return response.json()
+
+
+# Finished playlists per (session, emotion); a store rather than st.cache_data because
+# streaming writes into a placeholder created outside the function, which cache_data can't replay
+@st.cache_resource
+def recommendation_cache():
+    return TTLCache(maxsize=256, ttl=RECOMMENDATION_CACHE_TTL)
+
+
+def get_recommendations(session_id, emotion, placeholder):
+    key = (session_id, emotion)
+    recommendations = recommendation_cache().get(key)
+    if recommendations is None:
+        recommendations = stream_recommendations(session_id, emotion, placeholder)
+        # Lazy playlists only need their first tracks here; otherwise nothing resolves the rest later
+        resolve_links(recommendations[:PLAYER_PREFETCH + 1] if PLAYER_BACKEND_URL else recommendations)
+        recommendation_cache().set(key, recommendations)
+    return recommendations
+
+
+# Resolve YouTube links before the player is built; in lazy mode the player resolves the rest as it goes
+def resolve_links(tracks):
+    missing = [track for track in tracks if 'yt_link' not in track]
+    if not missing:
+        return
+    try:
+        response = backend.post(f"{BACKEND_URL}/resolve", json={
+            "tracks": [{"track": track['track'], "artist": track['artist']} for track in missing]
+        })
+        response.raise_for_status()
+        result = response.json()
+    except Exception:
+        return  # the player retries these from the browser, or skips them
+    for index, (track, link) in enumerate(zip(missing, result["yt_links"])):
+        if index not in result["unresolved"]:
+            track['yt_link'] = link
+
+
+# Fetch recommendations from the streaming endpoint, updating the placeholder per event
+def stream_recommendations(session_id, emotion, placeholder):
+    response = backend.post(
+        f"{BACKEND_URL}/get_recommendations/stream",
+        json={"session_id": session_id, "emotion": emotion, "resolve": PLAYER_RESOLVE},
+        stream=True
+    )
+
+    if response.status_code == 401:
+        # The backend could not refresh the Spotify session; a new login is needed
+        st.session_state.spotify_authenticated = False
+        st.session_state.spotify_session = None
+        raise Exception("Your Spotify session has ended, please reconnect from the sidebar.")
+
+    if response.status_code != 200:
+        raise Exception(response.json().get('detail') or response.json().get('error', 'Failed to get recommendations'))
+
+    tags = []
+    recommendations = []
+    with response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+
+            if event["event"] == "tags":
+                tags = event["tags"]
+            elif event["event"] == "track":
+                recommendations.append({"track": event["track"], "artist": event["artist"], "tag": event["tag"]})
+            elif event["event"] == "yt_link":
+                recommendations[event["index"]]["yt_link"] = event["yt_link"]
+            elif event["event"] == "error":
+                raise Exception(event.get("detail") or event["error"])
+            else:
+                continue
+
+            placeholder.markdown(render_progress(tags, recommendations))
+
+    return recommendations
+
+
 # Page config
 st.set_page_config(page_title="Music Recommendation Chatbot", page_icon="🎵")
 
@@ -196,7 +409,7 @@ with st.sidebar:
         st.success("✅ Spotify Connected")
         if st.button("Disconnect Spotify"):
             st.session_state.spotify_authenticated = False
-            st.session_state.spotify_token = None
+            st.session_state.spotify_session = None
             st.session_state.messages.append(
                 {"role": "assistant", "content": "Spotify disconnected. You can reconnect anytime."})
             st.rerun()
@@ -207,10 +420,10 @@ for message in st.session_state.messages:
         st.markdown(message["content"])
 
 # Display music player if we have recommendations
-if st.session_state.recommendations and any('yt_link' in track for track in st.session_state.recommendations):
+if st.session_state.recommendations:
     st.markdown("### Your Personal Playlist")
     components.html(
-        create_music_player(st.session_state.recommendations),
+        cached_player_html(playlist_key(st.session_state.recommendations), st.session_state.recommendations),
         height=500
     )
 
@@ -229,12 +442,7 @@ if prompt := st.chat_input("How are you feeling today?"):
             st.session_state.messages.append({"role": "assistant", "content": "Analyzing your mood..."})
 
             try:
-                response = requests.post(
-                    f"{BACKEND_URL}/detect_emotion",
-                    json={"text": prompt}
-                )
-                response.raise_for_status()
-                result = response.json()
+                result = detect_emotion(prompt)
 
                 if "error" in result:
                     raise Exception(result["error"])
@@ -271,7 +479,7 @@ if prompt := st.chat_input("How are you feeling today?"):
             st.session_state.messages.append({"role": "assistant", "content": "Connecting to Spotify..."})
 
             try:
-                response = requests.post(
+                response = backend.post(
                     f"{BACKEND_URL}/get_spotify_token",
                     json={"auth_code": prompt}
                 )
@@ -281,10 +489,10 @@ if prompt := st.chat_input("How are you feeling today?"):
                 if "error" in result:
                     raise Exception(result["error"])
 
-                if not result.get("access_token"):
+                if not result.get("session_id"):
                     raise Exception("Failed to get access token from Spotify")
 
-                st.session_state.spotify_token = result["access_token"]
+                st.session_state.spotify_session = result["session_id"]
                 st.session_state.spotify_authenticated = True
 
                 message = "Successfully connected to Spotify! This connection will be remembered."
@@ -312,23 +520,13 @@ if prompt := st.chat_input("How are you feeling today?"):
                     {"role": "assistant", "content": "Generating personalized recommendations..."})
 
                 try:
-                    response = requests.post(
-                        f"{BACKEND_URL}/get_recommendations",
-                        json={
-                            "access_token": st.session_state.spotify_token,
-                            "emotion": st.session_state.detected_emotion
-                        }
+                    recommendations = get_recommendations(
+                        st.session_state.spotify_session,
+                        st.session_state.detected_emotion,
+                        st.empty()
                     )
 
-                    if response.status_code != 200:
-                        raise Exception(response.json().get('detail', 'Failed to get recommendations'))
-
-                    result = response.json()
-
-                    if "error" in result:
-                        raise Exception(result["error"])
-
-                    st.session_state.recommendations = result["recommendations"]
+                    st.session_state.recommendations = recommendations
                     st.session_state.current_track_index = 0
                     st.session_state.player_created = True
 
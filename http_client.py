@@ -0,0 +1,125 @@
+import os
+import time
+import random
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Defaults for every upstream; HTTP_POOL_SIZE_<NAME> overrides the pool size for one of them
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))
+HTTP_RETRY_AFTER_MAX = float(os.getenv("HTTP_RETRY_AFTER_MAX", "10"))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class JitteredRetry(Retry):
+    """Retry policy with full-jitter backoff, used for connection and read failures"""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+def backoff_delay(attempt):
+    """Full-jitter backoff before retry number attempt + 1"""
+    return random.uniform(0, HTTP_BACKOFF * 2 ** attempt)
+
+
+def retry_after_seconds(headers, default=1.0):
+    """Seconds from a numeric Retry-After header, capped like retries are"""
+    try:
+        seconds = float(headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        seconds = default
+    return min(max(seconds, 0.0), HTTP_RETRY_AFTER_MAX)
+
+
+class TimeoutSession(requests.Session):
+    """requests session that applies a default timeout to every call and retries 429/5xx answers.
+
+    With a limiter, every attempt waits for its budget and every 429 throttles
+    it, so retries are paced like first attempts across workers.
+    """
+
+    def __init__(self, timeout, limiter=None, retries=0, retry_methods=Retry.DEFAULT_ALLOWED_METHODS):
+        super().__init__()
+        self.timeout = timeout
+        self.limiter = limiter
+        self.retries = retries
+        self.retry_methods = retry_methods
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        retries = self.retries if method.upper() in self.retry_methods else 0
+        for attempt in range(retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+
+            response = super().request(method, url, *args, **kwargs)
+            if self.limiter is not None and response.status_code == 429:
+                self.limiter.throttle(retry_after_seconds(response.headers))
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+
+            delay = backoff_delay(attempt)
+            if "Retry-After" in response.headers:
+                delay = retry_after_seconds(response.headers, delay)
+            response.close()
+            time.sleep(delay)
+
+
+def create_session(pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                   read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES, retry_methods=None, limiter=None):
+    """Build a keep-alive session with pooled connections and retry on 429/5xx.
+
+    Only idempotent methods are retried unless retry_methods says otherwise.
+    After the last retry the final response is returned, not raised.
+    """
+    retry_methods = retry_methods or Retry.DEFAULT_ALLOWED_METHODS
+    # Status retries happen in the session so each one goes through the limiter
+    retry = JitteredRetry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=0,
+        backoff_factor=HTTP_BACKOFF,
+        allowed_methods=retry_methods,
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+    session = TimeoutSession((connect_timeout, read_timeout), limiter=limiter, retries=retries,
+                             retry_methods=retry_methods)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def session(name, **options):
+    """Return the process-wide session for an upstream, creating it on first use"""
+    existing = _sessions.get(name)
+    if existing is not None:
+        return existing
+
+    with _sessions_lock:
+        if name not in _sessions:
+            options.setdefault("pool_size", int(os.getenv(f"HTTP_POOL_SIZE_{name.upper()}", HTTP_POOL_SIZE)))
+            options.setdefault("limiter", ratelimit.limiter(name))
+            _sessions[name] = create_session(**options)
+            logger.debug(f"Created HTTP session for {name} with {options}")
+        return _sessions[name]
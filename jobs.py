@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# Queue file shared by every process that opens it; set it empty to keep jobs in memory
+JOB_DB = os.getenv("JOB_DB", "jobs.db")
+# Worker threads per process; 0 accepts submissions but leaves running them to other processes
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Jobs allowed to wait in the queue before submissions are refused
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "1000"))
+# A running job whose worker has not reported for this long is failed as interrupted;
+# workers renew the lease of every job they run every JOB_LEASE / 3 seconds
+JOB_LEASE = float(os.getenv("JOB_LEASE", "300"))
+# Finished jobs, their results and events are kept this long
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "86400"))
+# How often idle workers and subscribers look for work submitted by other processes
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+# Longest a subscriber stream stays open before it ends with the current status
+JOB_SUBSCRIBE_TIMEOUT = float(os.getenv("JOB_SUBSCRIBE_TIMEOUT", "300"))
+
+# Lower runs first; submissions are clamped into this range
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler once its job has been cancelled, or taken away from this worker"""
+
+
+class QueueFull(Exception):
+    """Too many jobs are already waiting"""
+
+
+class Job:
+    """What a handler sees of the job it is running"""
+
+    def __init__(self, queue, job_id, kind, payload, owner):
+        self.queue = queue
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.owner = owner
+        self.sequence = 0
+
+    @property
+    def cancelled(self):
+        return self.queue._cancel_requested(self.id, self.owner)
+
+    def check(self):
+        """Raise JobCancelled if the job was cancelled; call between steps"""
+        if self.cancelled:
+            raise JobCancelled(self.id)
+
+    def emit(self, event):
+        """Store one partial result for pollers and subscribers, then honour cancellation"""
+        self.sequence += 1
+        self.queue._append_event(self.id, self.sequence, event)
+        self.check()
+
+
+class JobQueue:
+    """Durable priority queue for long-running work, with a local worker pool.
+
+    Jobs live in SQLite, so several processes can share one queue and queued
+    jobs survive restarts. A handler registered per kind runs with a Job,
+    emits partial results through job.emit() and returns the final result.
+    """
+
+    def __init__(self, path=JOB_DB, workers=JOB_WORKERS, max_queued=JOB_MAX_QUEUED, lease=JOB_LEASE,
+                 retention=JOB_RETENTION, poll_interval=JOB_POLL_INTERVAL):
+        self.path = path or ":memory:"
+        self.workers = workers
+        self.max_queued = max_queued
+        self.lease = lease
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition()
+        self._threads = []
+        self._running = {}  # job id -> lease owner, for jobs this process is running
+        self._purged_at = 0.0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, priority INTEGER NOT NULL, "
+            "status TEXT NOT NULL, payload TEXT NOT NULL, result TEXT, error TEXT, "
+            "cancel_requested INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, started_at REAL, "
+            "finished_at REAL, lease_until REAL, lease_owner TEXT)"
+        )
+        try:
+            # Queues created before leases had owners
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN lease_owner TEXT")
+        except sqlite3.OperationalError:
+            pass
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_events (job_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+            "event TEXT NOT NULL, PRIMARY KEY (job_id, seq))"
+        )
+
+    def register(self, kind, handler):
+        """handler(payload, job) -> JSON-serializable result"""
+        self.handlers[kind] = handler
+
+    def submit(self, kind, payload, priority=PRIORITY_NORMAL):
+        """Queue a job and return its id; raises QueueFull when the backlog is at its cap"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        priority = min(max(int(priority), PRIORITY_HIGH), PRIORITY_LOW)
+        job_id = uuid.uuid4().hex
+
+        with self._lock:
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull(f"{queued} jobs already queued")
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, priority, status, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, priority, QUEUED, json.dumps(payload), time.time())
+            )
+            self.submitted += 1
+
+        with self._wake:
+            self._wake.notify()
+        return job_id
+
+    def get(self, job_id, after=0):
+        """Status, result and the events after sequence `after` for one job, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT kind, priority, status, result, error, created_at, started_at, finished_at "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            events = self._conn.execute(
+                "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after)
+            ).fetchall()
+
+        kind, priority, status, result, error, created_at, started_at, finished_at = row
+        if status == QUEUED:
+            position = self._position(priority, created_at)
+        else:
+            position = None
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "priority": priority,
+            "status": status,
+            "queue_position": position,
+            "events": [json.loads(event) for _, event in events],
+            "next": events[-1][0] if events else after,
+            "result": json.loads(result) if result is not None else None,
+            "error": json.loads(error) if error is not None else None,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at
+        }
+
+    def _position(self, priority, created_at):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND (priority < ? OR (priority = ? AND created_at < ?))",
+                (QUEUED, priority, priority, created_at)
+            ).fetchone()[0]
+
+    def follow(self, job_id, after=0, timeout=JOB_SUBSCRIBE_TIMEOUT):
+        """Yield events as they are stored, then the job state once it finishes or timeout passes"""
+        deadline = time.monotonic() + timeout
+        while True:
+            state = self.get(job_id, after)
+            if state is None:
+                return
+            for event in state["events"]:
+                yield event
+            after = state["next"]
+            if state["status"] in FINISHED or time.monotonic() >= deadline:
+                state.pop("events")
+                yield {"event": "status", **state}
+                return
+            time.sleep(min(self.poll_interval, 0.2))
+
+    def cancel(self, job_id):
+        """Cancel a queued job now, or ask a running one to stop; returns the status, or None"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if row is None:
+                    status = None
+                elif row[0] == QUEUED:
+                    self._conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?",
+                                       (CANCELLED, time.time(), job_id))
+                    self.cancelled += 1
+                    status = CANCELLED
+                else:
+                    if row[0] == RUNNING:
+                        self._conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+                    status = row[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return status
+
+    def _cancel_requested(self, job_id, owner):
+        """Whether a running job was cancelled, or no longer belongs to this run of it"""
+        with self._lock:
+            row = self._conn.execute("SELECT cancel_requested, status, lease_owner FROM jobs WHERE id = ?",
+                                     (job_id,)).fetchone()
+        return row is None or bool(row[0]) or row[1] != RUNNING or row[2] != owner
+
+    def _append_event(self, job_id, sequence, event):
+        with self._lock:
+            self._conn.execute("INSERT INTO job_events (job_id, seq, event) VALUES (?, ?, ?)",
+                               (job_id, sequence, json.dumps(event)))
+
+    def _renew_leases(self):
+        """Push back the lease of every job this process is running"""
+        with self._lock:
+            running = list(self._running.items())
+            now = time.time()
+            for job_id, owner in running:
+                self._conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                                   (now + self.lease, job_id, RUNNING, owner))
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease / 3)
+            try:
+                self._renew_leases()
+            except sqlite3.Error as e:
+                logger.error(f"Job lease renewal failed: {str(e)}")
+
+    def _claim(self):
+        """Atomically take the next queued job, highest priority then oldest first"""
+        with self._lock:
+            # IMMEDIATE takes the write lock up front so two processes never claim the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                # A worker that stopped reporting died mid-job; its partial results may be incomplete
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status = ? AND lease_until < ?",
+                    (FAILED, json.dumps({"error": "Job interrupted", "status": 500}), now, RUNNING, now)
+                )
+                row = self._conn.execute(
+                    "SELECT id, kind, payload FROM jobs WHERE status = ? ORDER BY priority, created_at LIMIT 1",
+                    (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    owner = uuid.uuid4().hex
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, started_at = ?, lease_until = ?, lease_owner = ? WHERE id = ?",
+                        (RUNNING, now, now + self.lease, owner, row[0])
+                    )
+                    row = (*row, owner)
+                    self._running[row[0]] = owner
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def _finish(self, job_id, owner, status, result=None, error=None):
+        """Record a job's outcome unless its lease was lost meanwhile; returns whether it was recorded"""
+        # Payloads can carry access tokens; drop them once the job no longer needs them
+        with self._lock:
+            self._running.pop(job_id, None)
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, payload = '{}' "
+                "WHERE id = ? AND status = ? AND lease_owner = ?",
+                (status, json.dumps(result) if result is not None else None,
+                 json.dumps(error) if error is not None else None, time.time(), job_id, RUNNING, owner)
+            )
+        if cursor.rowcount == 0:
+            logger.warning(f"Job {job_id} lost its lease before finishing; its {status} outcome was dropped")
+            return False
+        return True
+
+    def _execute(self, job_id, kind, payload, owner):
+        job = Job(self, job_id, kind, json.loads(payload), owner)
+        handler = self.handlers.get(kind)
+        start = time.perf_counter()
+        try:
+            if handler is None:
+                raise ValueError(f"No handler for job kind {kind} in this process")
+            job.check()
+            result = handler(job.payload, job)
+            # A cancel that arrived after the handler's last check still wins over its result
+            job.check()
+        except JobCancelled:
+            if self._finish(job_id, owner, CANCELLED):
+                self.cancelled += 1
+                logger.info(f"Cancelled {kind} job {job_id}")
+            return
+        except Exception as e:
+            # Pipeline errors carry an HTTP status and detail; keep them for the poller
+            if self._finish(job_id, owner, FAILED, error={
+                "error": getattr(e, "error", str(e)),
+                "detail": getattr(e, "detail", None),
+                "status": getattr(e, "status_code", 500)
+            }):
+                self.failed += 1
+                logger.error(f"{kind} job {job_id} failed: {str(e)}")
+            return
+        if self._finish(job_id, owner, DONE, result=result):
+            self.completed += 1
+            logger.info(f"Finished {kind} job {job_id} in {time.perf_counter() - start:.1f}s")
+
+    def purge(self):
+        """Drop finished jobs and their events once past retention"""
+        cutoff = time.time() - self.retention
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)", (cutoff,)
+            )
+            self._conn.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+
+    def _run(self):
+        while True:
+            try:
+                row = self._claim()
+                if row is None:
+                    if time.time() - self._purged_at > 60:
+                        self._purged_at = time.time()
+                        self.purge()
+                    with self._wake:
+                        self._wake.wait(self.poll_interval)
+                    continue
+                # Run each job in a fresh context so nothing leaks between jobs on one thread
+                contextvars.Context().run(self._execute, *row)
+            except sqlite3.Error as e:
+                logger.error(f"Job queue error: {str(e)}")
+                time.sleep(self.poll_interval)
+
+    def start(self):
+        """Start the worker threads once per process"""
+        with self._lock:
+            if self._threads:
+                return
+            self._threads = [threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+                             for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {
+            "workers": len(self._threads),
+            "jobs": {status: counts.get(status, 0) for status in (QUEUED, RUNNING) + FINISHED},
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled
+        }
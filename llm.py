@@ -0,0 +1,349 @@
+import os
+import copy
+import json
+import time
+import inspect
+import logging
+import threading
+import contextlib
+from collections import Counter
+
+import lmstudio as lms
+
+import http_client
+import structured
+from caching import TTLCache
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "1800"))
+
+# Set to an OpenAI-compatible base URL (LM Studio serves one at http://localhost:1234/v1)
+# to call it over HTTP instead of through the lmstudio SDK
+LLM_OPENAI_URL = os.getenv("LLM_OPENAI_URL")
+LLM_OPENAI_MODEL = os.getenv("LLM_OPENAI_MODEL", "local-model")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+
+# Ask for schema-constrained output; when the backend rejects it, answers are extracted from
+# free text and constrained decoding is tried again after LLM_STRUCTURED_RETRY seconds
+LLM_STRUCTURED = os.getenv("LLM_STRUCTURED", "1") != "0"
+LLM_STRUCTURED_RETRY = float(os.getenv("LLM_STRUCTURED_RETRY", "600"))
+# Most characters of a bad answer sent back in the repair turn
+LLM_REPAIR_MAX_CHARS = 4000
+
+# Model tier per call site; LLM_TIER_<TASK> overrides, unknown tasks use "default"
+TASK_TIERS = {
+    "emotion": "fast",
+    "emotion_batch": "fast",
+    "tags": "fast",
+    "feedback": "large",
+}
+# Each tier runs LLM_MODEL_<TIER> (empty: whatever model is loaded, or LLM_OPENAI_MODEL over HTTP)
+# with at most LLM_CONCURRENCY_<TIER> calls in flight; callers beyond that queue for LLM_QUEUE_TIMEOUT
+DEFAULT_CONCURRENCY = {"fast": 4, "large": 1, "default": 2}
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "60"))
+
+# Error text that means the backend can't do constrained decoding at all, as opposed to a
+# request it refused for another reason (context length, bad parameters, overload)
+SCHEMA_UNSUPPORTED_MARKERS = ("response_format", "json_schema", "structured output", "grammar")
+
+REPAIR_SYSTEM_PROMPT = ("You fix malformed JSON. Respond ONLY with one JSON value that matches the schema, "
+                        "keeping the content of the original answer.")
+
+# ("json", call site, normalized system prompt, normalized user message) -> (answer, seconds the inference took)
+_responses = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+_flight = SingleFlight("llm")
+_stats_lock = threading.Lock()
+_inference_seconds = 0.0
+_saved_seconds = 0.0
+_structured_retry_at = 0.0 if LLM_STRUCTURED else float("inf")
+# How JSON answers were obtained: parsed, repaired, unrepaired, and fallback when a caller's default was used
+_json_outcomes = Counter()
+
+
+class StructuredUnsupported(Exception):
+    """The backend rejected a schema-constrained request"""
+
+
+class ModelBusy(Exception):
+    """No inference slot for the tier freed up within the queue timeout"""
+
+
+class ModelPool:
+    """One model tier: a warm model handle and a cap on concurrent inferences.
+
+    Each tier queues on its own, so cheap classification calls never wait
+    behind long conversational ones on another tier.
+    """
+
+    def __init__(self, tier, model_key, concurrency, queue_timeout=LLM_QUEUE_TIMEOUT):
+        self.tier = tier
+        self.model_key = model_key
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._handle = None
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    def handle(self):
+        """Return the LM Studio handle for this tier's model, loading it on first use"""
+        if self._handle is None:
+            with self._lock:
+                if self._handle is None:
+                    self._handle = lms.llm(self.model_key) if self.model_key else lms.llm()
+        return self._handle
+
+    def reset(self):
+        """Drop the handle so the next call reconnects"""
+        with self._lock:
+            self._handle = None
+
+    def warm(self):
+        """Load the model ahead of the first request"""
+        try:
+            self.handle()
+        except Exception as e:
+            logger.error(f"Failed to warm {self.tier} model {self.model_key or '(default)'}: {str(e)}")
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold one of the tier's inference slots, queueing for up to queue_timeout"""
+        start = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+        acquired = self._slots.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self.waiting -= 1
+            self.wait_seconds += time.perf_counter() - start
+            if not acquired:
+                self.rejected += 1
+            else:
+                self.in_flight += 1
+                self.calls += 1
+        if not acquired:
+            raise ModelBusy(f"No {self.tier} model slot within {self.queue_timeout}s")
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "model": self.model_key or None,
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "wait_seconds": round(self.wait_seconds, 3)
+        }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def tier_for(task):
+    return os.getenv(f"LLM_TIER_{(task or 'default').upper()}", TASK_TIERS.get(task, "default"))
+
+
+def model_pool(task=None):
+    """Return the process-wide pool for the tier a call site is routed to"""
+    tier = tier_for(task)
+    if tier not in _pools:
+        with _pools_lock:
+            if tier not in _pools:
+                _pools[tier] = ModelPool(
+                    tier,
+                    os.getenv(f"LLM_MODEL_{tier.upper()}", ""),
+                    int(os.getenv(f"LLM_CONCURRENCY_{tier.upper()}", str(DEFAULT_CONCURRENCY.get(tier, 2))))
+                )
+    return _pools[tier]
+
+
+def warm_models():
+    """Load every routed model in the background so first requests don't pay for it"""
+    if LLM_OPENAI_URL:
+        return
+    pools = {id(pool): pool for pool in (model_pool(task) for task in TASK_TIERS)}
+    for pool in pools.values():
+        threading.Thread(target=pool.warm, name=f"llm-warm-{pool.tier}", daemon=True).start()
+
+
+def rejects_schema(error_text):
+    text = error_text.lower()
+    return any(marker in text for marker in SCHEMA_UNSUPPORTED_MARKERS)
+
+
+def accepts_response_format(handle):
+    """Whether the SDK's respond() takes response_format; older releases don't"""
+    try:
+        parameters = inspect.signature(handle.respond).parameters
+    except (TypeError, ValueError):
+        return True
+    return "response_format" in parameters or any(parameter.kind == parameter.VAR_KEYWORD
+                                                  for parameter in parameters.values())
+
+
+def _respond_openai(pool, system_prompt, user_message, schema=None, name=None):
+    session = http_client.session("llm", read_timeout=LLM_TIMEOUT)
+    body = {
+        "model": pool.model_key or LLM_OPENAI_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message}
+        ]
+    }
+    if schema is not None:
+        body["response_format"] = {"type": "json_schema",
+                                   "json_schema": {"name": name or "answer", "schema": schema, "strict": True}}
+    response = session.post(f"{LLM_OPENAI_URL.rstrip('/')}/chat/completions", json=body)
+    if schema is not None and response.status_code in (400, 422) and rejects_schema(response.text):
+        raise StructuredUnsupported(response.text[:200])
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"].strip()
+
+
+def _respond_lms(pool, system_prompt, user_message, schema=None):
+    chat = lms.Chat(system_prompt)
+    chat.add_user_message(user_message)
+    if schema is not None and not accepts_response_format(pool.handle()):
+        raise StructuredUnsupported("This lmstudio SDK release has no response_format")
+    try:
+        if schema is None:
+            return pool.handle().respond(chat).content.strip()
+        return pool.handle().respond(chat, response_format=schema).content.strip()
+    except Exception as e:
+        if schema is not None and rejects_schema(str(e)):
+            raise StructuredUnsupported(str(e))
+        pool.reset()
+        raise
+
+
+def _respond(system_prompt, user_message, schema=None, name=None):
+    """One model call on the tier `name` routes to; constrained to `schema` while the backend accepts that"""
+    with model_pool(name).slot() as pool:
+        return _respond_in_slot(pool, system_prompt, user_message, schema, name)
+
+
+def _respond_in_slot(pool, system_prompt, user_message, schema, name):
+    global _structured_retry_at
+    if schema is not None and time.time() >= _structured_retry_at:
+        try:
+            if LLM_OPENAI_URL:
+                return _respond_openai(pool, system_prompt, user_message, schema, name)
+            return _respond_lms(pool, system_prompt, user_message, schema)
+        except StructuredUnsupported as e:
+            _structured_retry_at = time.time() + LLM_STRUCTURED_RETRY
+            logger.warning(f"Constrained output failed, extracting JSON from free text for now: {str(e)}")
+
+    if LLM_OPENAI_URL:
+        return _respond_openai(pool, system_prompt, user_message)
+    return _respond_lms(pool, system_prompt, user_message)
+
+
+def normalize_prompt(text):
+    return " ".join(text.split())
+
+
+def _infer(key, system_prompt, user_message, schema=None, name=None):
+    """Run the model and memoize under key; returns (content, seconds)"""
+    global _inference_seconds
+    start = time.perf_counter()
+    content = _respond(system_prompt, user_message, schema, name)
+    elapsed = time.perf_counter() - start
+
+    with _stats_lock:
+        _inference_seconds += elapsed
+    if key is not None and content:
+        _responses.set(key, (content, elapsed))
+    return content, elapsed
+
+
+def complete_json(system_prompt, user_message, schema, name, fallback=None, use_cache=True, on_inference=None):
+    """Run one chat turn for a JSON answer matching `schema`, memoizing valid answers.
+
+    Decoding is schema-constrained where the backend supports it and the
+    JSON is extracted tolerantly from whatever comes back. An answer that
+    still doesn't fit gets one short repair turn, not a full retry; after
+    that `fallback(content)` supplies the value, or OutputError is raised.
+    `on_inference(value)` runs only when a new inference produced a valid
+    answer, not for cached, shared or fallback ones.
+    """
+    global _saved_seconds
+    key = ("json", name, normalize_prompt(system_prompt), normalize_prompt(user_message))
+
+    try:
+        if use_cache:
+            cached = _responses.get(key)
+            if cached is not None:
+                value, elapsed = cached
+                with _stats_lock:
+                    _saved_seconds += elapsed
+            else:
+                value, _ = _flight.do(key, _infer_json, key, system_prompt, user_message, schema, name,
+                                      on_inference)
+        else:
+            value, _ = _infer_json(None, system_prompt, user_message, schema, name, on_inference)
+    except structured.OutputError as e:
+        if fallback is None:
+            raise
+        with _stats_lock:
+            _json_outcomes["fallback"] += 1
+        return fallback(e.content)
+
+    # Cached and shared answers must not be changed by one caller
+    return copy.deepcopy(value)
+
+
+def _infer_json(key, system_prompt, user_message, schema, name, on_inference=None):
+    """Parse, repair once if needed, and memoize under key; returns (value, seconds)"""
+    content, elapsed = _infer(None, system_prompt, user_message, schema, name)
+    try:
+        value = structured.parse(content, schema)
+        outcome = "parsed"
+    except structured.OutputError as e:
+        logger.warning(f"Unusable {name} answer ({str(e)}), trying one repair turn")
+        repair_message = (f"Schema:\n{json.dumps(schema)}\n\nProblems: {str(e)}\n\n"
+                          f"Answer to fix:\n{content[:LLM_REPAIR_MAX_CHARS]}")
+        repaired, repair_elapsed = _infer(None, REPAIR_SYSTEM_PROMPT, repair_message, schema, name)
+        elapsed += repair_elapsed
+        try:
+            value = structured.parse(repaired, schema)
+            outcome = "repaired"
+        except structured.OutputError as e:
+            logger.warning(f"Repair turn for {name} failed too: {str(e)}")
+            with _stats_lock:
+                _json_outcomes["unrepaired"] += 1
+            raise structured.OutputError(f"Unusable {name} answer: {str(e)}", content=content)
+
+    with _stats_lock:
+        _json_outcomes[outcome] += 1
+    if key is not None:
+        _responses.set(key, (value, elapsed))
+    if on_inference is not None:
+        try:
+            on_inference(copy.deepcopy(value))
+        except Exception as e:
+            logger.warning(f"on_inference hook for {name} failed: {str(e)}")
+    return value, elapsed
+
+
+def stats():
+    stats = _responses.stats()
+    stats["inference_seconds"] = round(_inference_seconds, 3)
+    stats["saved_inference_seconds"] = round(_saved_seconds, 3)
+    stats["coalesced"] = _flight.shared
+    stats["json_answers"] = dict(_json_outcomes)
+    stats["structured_output"] = time.time() >= _structured_retry_at
+    stats["models"] = {tier: pool.stats() for tier, pool in _pools.items()}
+    return stats
@@ -0,0 +1,115 @@
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+
+# Latency buckets in seconds, from cache hits up to slow LLM calls
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with string labels"""
+
+    def __init__(self, name, description, label_names, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = [(key, list(series)) for key, series in sorted(self._series.items())]
+
+        for key, series in series_items:
+            labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Trace:
+    """Stage timings collected for one request, rendered as a Server-Timing header"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._stages = {}  # stage -> [total seconds, calls]
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            totals = self._stages.setdefault(stage, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def server_timing(self):
+        """Per-stage summed durations (ms) with call counts, plus the total so far"""
+        with self._lock:
+            stages = list(self._stages.items())
+        entries = [f'{stage};desc="x{calls}";dur={seconds * 1000:.1f}' for stage, (seconds, calls) in stages]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+
+stage_seconds = Histogram(
+    "nullify_stage_duration_seconds", "Time spent in each pipeline stage", ("stage",))
+request_seconds = Histogram(
+    "nullify_request_duration_seconds", "Time until response headers per endpoint", ("endpoint", "status"))
+
+
+def start_trace():
+    """Begin collecting stage timings for the current request"""
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Time a block into the stage histogram and the current request's trace"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
+
+
+def render():
+    return "\n".join(stage_seconds.render() + request_seconds.render()) + "\n"
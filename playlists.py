@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import heapq
+import hashlib
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+# Stored playlists live in memory, bounded by total size and age
+PLAYLIST_STORE_MAX_BYTES = int(os.getenv("PLAYLIST_STORE_MAX_BYTES", str(64 * 1024 * 1024)))
+PLAYLIST_TTL = float(os.getenv("PLAYLIST_TTL", "3600"))
+
+
+# Streamed exports are flushed in chunks of roughly this many bytes
+EXPORT_CHUNK_SIZE = 64 * 1024
+PLAYLIST_TITLE = "Music Recommendations"
+
+
+def canonical_tracks(recommendations):
+    """Keep only the fields exports use, so equal playlists hash the same"""
+    return [
+        {"track": track.get('track'), "artist": track.get('artist'), "yt_link": track.get('yt_link')}
+        for track in recommendations
+    ]
+
+
+def _line(value):
+    """One field for a line-based format; a line break in a title could otherwise inject entries"""
+    return " ".join(str(value).splitlines())
+
+
+def _title(track):
+    return _line(f"{track['artist']} - {track['track']}")
+
+
+def write_m3u(tracks, title=PLAYLIST_TITLE):
+    yield "#EXTM3U\n"
+    for track in tracks:
+        if track['yt_link']:
+            yield f"#EXTINF:-1,{_title(track)}\n{_line(track['yt_link'])}\n"
+
+
+def write_m3u8(tracks, title=PLAYLIST_TITLE):
+    yield "#EXTM3U\n"
+    yield f"#PLAYLIST:{_line(title)}\n"
+    for track in tracks:
+        if track['yt_link']:
+            yield f"#EXTINF:-1,{_title(track)}\n{_line(track['yt_link'])}\n"
+
+
+def write_pls(tracks, title=PLAYLIST_TITLE):
+    yield "[playlist]\n"
+    count = 0
+    for track in tracks:
+        if track['yt_link']:
+            count += 1
+            yield f"File{count}={_line(track['yt_link'])}\nTitle{count}={_title(track)}\nLength{count}=-1\n"
+    yield f"NumberOfEntries={count}\nVersion=2\n"
+
+
+def write_xspf(tracks, title=PLAYLIST_TITLE):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield f'<playlist version="1" xmlns="http://xspf.org/ns/0/">\n  <title>{escape(title)}</title>\n  <trackList>\n'
+    for track in tracks:
+        parts = ["    <track>"]
+        if track['yt_link']:
+            parts.append(f"<location>{escape(track['yt_link'])}</location>")
+        parts.append(f"<title>{escape(track['track'] or '')}</title>")
+        parts.append(f"<creator>{escape(track['artist'] or '')}</creator>")
+        parts.append("</track>\n")
+        yield "".join(parts)
+    yield "  </trackList>\n</playlist>\n"
+
+
+def write_jspf(tracks, title=PLAYLIST_TITLE):
+    yield '{"playlist": {"title": ' + json.dumps(title) + ', "track": ['
+    for i, track in enumerate(tracks):
+        entry = {"title": track['track'], "creator": track['artist']}
+        if track['yt_link']:
+            entry["location"] = [track['yt_link']]
+        yield ("," if i else "") + json.dumps(entry, ensure_ascii=False)
+    yield "]}}\n"
+
+
+# format -> (writer, mimetype, file extension)
+EXPORT_FORMATS = {
+    "m3u": (write_m3u, "audio/x-mpegurl", "m3u"),
+    "m3u8": (write_m3u8, "application/vnd.apple.mpegurl", "m3u8"),
+    "pls": (write_pls, "audio/x-scpls", "pls"),
+    "xspf": (write_xspf, "application/xspf+xml", "xspf"),
+    "jspf": (write_jspf, "application/jspf+json", "jspf"),
+}
+
+
+def iter_tracks(content):
+    """Decode a stored track list one track at a time, so exports don't build the whole list first"""
+    text = content.decode("utf-8")
+    decoder = json.JSONDecoder()
+    position = 1  # past the opening "["
+    while text[position] != "]":
+        track, position = decoder.raw_decode(text, position)
+        yield track
+        if text[position] == ",":
+            position += 1
+
+
+def export(fmt, tracks, chunk_size=EXPORT_CHUNK_SIZE):
+    """Stream a playlist in the given format as UTF-8 byte chunks"""
+    writer = EXPORT_FORMATS[fmt][0]
+    buffer = []
+    size = 0
+    for piece in writer(tracks):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+class PlaylistTooLarge(ValueError):
+    """A playlist bigger than the whole store"""
+
+
+class PlaylistStore:
+    """Size-bounded LRU store of serialized playlists keyed by content hash.
+
+    Identical playlists hash to the same id and are stored once; the id
+    doubles as the ETag for downloads.
+    """
+
+    def __init__(self, max_bytes=PLAYLIST_STORE_MAX_BYTES, ttl=PLAYLIST_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # id -> (expires_at, content)
+        self._expiry = []  # heap of (expires_at, id); entries replaced or removed since are skipped
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.deduplicated = 0
+
+    @staticmethod
+    def content_id(content):
+        return hashlib.sha256(content).hexdigest()[:32]
+
+    def put(self, content):
+        """Store serialized bytes and return their id; raises PlaylistTooLarge past max_bytes"""
+        if len(content) > self.max_bytes:
+            raise PlaylistTooLarge(f"Playlist is {len(content)} bytes, the store holds at most {self.max_bytes}")
+        playlist_id = self.content_id(content)
+        expires_at = time.time() + self.ttl
+
+        with self._lock:
+            if playlist_id in self._data:
+                self.deduplicated += 1
+            else:
+                self._bytes += len(content)
+            self._data[playlist_id] = (expires_at, content)
+            self._data.move_to_end(playlist_id)
+            heapq.heappush(self._expiry, (expires_at, playlist_id))
+
+            # Drop every expired entry first, wherever it sits in LRU order, then the least recently used
+            now = time.time()
+            while self._expiry and self._expiry[0][0] <= now:
+                expired_at, expired_id = heapq.heappop(self._expiry)
+                entry = self._data.get(expired_id)
+                if entry is not None and entry[0] == expired_at:
+                    self._remove(expired_id)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+        return playlist_id
+
+    def get(self, playlist_id):
+        with self._lock:
+            entry = self._data.get(playlist_id)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self._remove(playlist_id)
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(playlist_id)
+            self.hits += 1
+            return entry[1]
+
+    def put_tracks(self, recommendations):
+        """Store a track list in canonical form and return its id"""
+        content = json.dumps(canonical_tracks(recommendations), separators=(",", ":"), ensure_ascii=False)
+        return self.put(content.encode("utf-8"))
+
+    def get_tracks(self, playlist_id):
+        """The stored track list as an iterator decoded lazily, or None"""
+        content = self.get(playlist_id)
+        return iter_tracks(content) if content is not None else None
+
+    def _remove(self, playlist_id):
+        _, content = self._data.pop(playlist_id)
+        self._bytes -= len(content)
+
+    def stats(self):
+        return {
+            "playlists": len(self._data),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "deduplicated": self.deduplicated
+        }
@@ -0,0 +1,131 @@
+import time
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+MAX_TRACKED_EMOTIONS = 10000
+
+
+def normalize_emotion(emotion):
+    return " ".join(str(emotion).lower().split())
+
+
+class CandidatePools:
+    """Precomputed candidate pools per emotion, kept warm by a background thread.
+
+    `build(emotion)` returns a pool (any value) or None. Requests read pools
+    with get(); record() counts demand so the most requested emotions are
+    refreshed every interval, and an emotion missed `min_demand` times gets
+    built right away.
+    """
+
+    def __init__(self, build, refresh_interval=600, max_age=1800, top_n=12, seeds=(), min_demand=2):
+        self.build = build
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.top_n = top_n
+        self.min_demand = min_demand
+        self.seeds = [normalize_emotion(seed) for seed in seeds if seed.strip()]
+        self._pools = {}  # emotion -> (built_at, pool)
+        self._demand = Counter()
+        self._requested = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.build_failures = 0
+
+    def get(self, emotion):
+        """Return the warm pool for an emotion, or None"""
+        key = normalize_emotion(emotion)
+        with self._lock:
+            entry = self._pools.get(key)
+            if entry is None or time.time() - entry[0] > self.max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def record(self, emotion):
+        """Count a request for an emotion; repeatedly missed emotions are queued for a build"""
+        key = normalize_emotion(emotion)
+        with self._lock:
+            self._demand[key] += 1
+            if len(self._demand) > MAX_TRACKED_EMOTIONS:
+                # Emotions are free text; keep only the most requested ones
+                self._demand = Counter(dict(self._demand.most_common(MAX_TRACKED_EMOTIONS // 2)))
+            if (self._demand[key] >= self.min_demand and key not in self._pools
+                    and key not in self._requested):
+                self._requested.append(key)
+                queued = True
+            else:
+                queued = False
+        if queued:
+            self._wake.set()
+
+    def refresh(self, emotion):
+        """Build and swap in the pool for one emotion"""
+        key = normalize_emotion(emotion)
+        start = time.perf_counter()
+        try:
+            pool = self.build(key)
+        except Exception as e:
+            logger.error(f"Failed to build candidate pool for {key}: {str(e)}")
+            pool = None
+
+        with self._lock:
+            self.builds += 1
+            if pool is None:
+                self.build_failures += 1
+                return None
+            self._pools[key] = (time.time(), pool)
+        logger.info(f"Built candidate pool for {key} in {time.perf_counter() - start:.1f}s")
+        return pool
+
+    def due(self):
+        """Emotions to rebuild now: queued misses, then seeds and top demand past the interval"""
+        now = time.time()
+        with self._lock:
+            emotions = list(self._requested)
+            self._requested.clear()
+            candidates = self.seeds + [emotion for emotion, _ in self._demand.most_common(self.top_n)]
+            for emotion in candidates:
+                entry = self._pools.get(emotion)
+                if emotion not in emotions and (entry is None or now - entry[0] >= self.refresh_interval):
+                    emotions.append(emotion)
+        return emotions
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            for emotion in self.due():
+                self.refresh(emotion)
+            self._wake.wait(timeout=min(60.0, self.refresh_interval))
+
+    def start(self):
+        """Start the refresh thread once per process"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="candidate-pools", daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            pools = {emotion: round(time.time() - built_at, 1) for emotion, (built_at, _) in self._pools.items()}
+            top = dict(self._demand.most_common(self.top_n))
+        return {
+            "pools": len(pools),
+            "pool_age_seconds": pools,
+            "demand": top,
+            "hits": self.hits,
+            "misses": self.misses,
+            "builds": self.builds,
+            "build_failures": self.build_failures,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
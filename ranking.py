@@ -0,0 +1,140 @@
+import os
+import zlib
+import logging
+
+import numpy as np
+
+from yt_index import normalize
+
+logger = logging.getLogger(__name__)
+
+# Hashed word space for matching tag words against the user's genre words
+RANKING_WORD_FEATURES = 1024
+
+# Score weights per feature; tune with RANKING_WEIGHTS="tag_overlap=1.0,artist=2.0,..."
+DEFAULT_WEIGHTS = {
+    "tag_overlap": 1.0,     # tag words shared with the user's genres
+    "artist": 2.0,          # track is by one of the user's top artists
+    "tag_relevance": 0.5,   # how early the LLM listed the track's tag
+    "popularity": 0.5,      # position in Last.fm's top tracks for the tag
+    "playable": 0.75,       # a YouTube link is known to exist
+    "jitter": 0.1,          # per-user noise so listeners get different slices
+}
+
+
+def parse_weights(spec):
+    """'artist=3,jitter=0' -> DEFAULT_WEIGHTS with those entries replaced"""
+    weights = dict(DEFAULT_WEIGHTS)
+    for part in spec.split(","):
+        name, _, value = part.partition("=")
+        if name.strip() in weights:
+            weights[name.strip()] = float(value)
+        elif name.strip():
+            logger.warning(f"Ignoring unknown ranking weight: {name}")
+    return weights
+
+
+RANKING_WEIGHTS = parse_weights(os.getenv("RANKING_WEIGHTS", ""))
+
+# Diversity reranking: score lost per already-picked track by the same artist / with the same tag
+RANKING_ARTIST_PENALTY = float(os.getenv("RANKING_ARTIST_PENALTY", "1.5"))
+RANKING_TAG_PENALTY = float(os.getenv("RANKING_TAG_PENALTY", "0.15"))
+
+
+def _hash(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def word_vector(phrases, n_features=RANKING_WORD_FEATURES):
+    """Binary hashed bag of the words in some phrases"""
+    vector = np.zeros(n_features, dtype=np.float32)
+    for phrase in phrases:
+        for word in normalize(phrase or "").split():
+            vector[_hash(word) % n_features] = 1.0
+    return vector
+
+
+class CandidateSet:
+    """Feature arrays for a list of candidate tracks, built once and scored per user.
+
+    Tracks are dicts with track, artist and tag, plus an optional "rank"
+    (position in Last.fm's list for the tag) and "yt_link" (None when known
+    to be missing; absent when not looked up yet).
+    """
+
+    def __init__(self, tracks, tags):
+        self.tracks = tracks
+        self.tags = list(tags)
+
+        tag_position = {tag: i for i, tag in enumerate(self.tags)}
+        for track in tracks:
+            if track['tag'] not in tag_position:
+                tag_position[track['tag']] = len(tag_position)
+                self.tags.append(track['tag'])
+
+        # Per-tag rows, indexed per track, so tag features cost O(tags) to score
+        self.tag_index = np.array([tag_position[track['tag']] for track in tracks], dtype=np.int64)
+        self.tag_words = np.stack([word_vector([tag]) for tag in self.tags]) if self.tags else \
+            np.zeros((0, RANKING_WORD_FEATURES), dtype=np.float32)
+        tag_relevance = 1.0 - np.arange(len(self.tags), dtype=np.float32) / max(len(self.tags), 1)
+        self.tag_relevance = tag_relevance[self.tag_index]
+
+        artist_names = [normalize(track['artist'] or "") for track in tracks]
+        self.artist_hash = np.array([_hash(name) for name in artist_names], dtype=np.uint32)
+        _, self.artist_index = np.unique(self.artist_hash, return_inverse=True)
+        self.identity = np.array([_hash(f"{name}:{normalize(track['track'] or '')}")
+                                  for name, track in zip(artist_names, tracks)], dtype=np.uint32)
+
+        ranks = np.array([track.get('rank', 0) for track in tracks], dtype=np.float32)
+        depth = np.bincount(self.tag_index, minlength=len(self.tags)).astype(np.float32)
+        self.popularity = 1.0 - ranks / np.maximum(depth[self.tag_index], 1.0)
+        self.playable = np.array([0.5 if 'yt_link' not in track else float(bool(track['yt_link']))
+                                  for track in tracks], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def score(self, profile, weights=RANKING_WEIGHTS):
+        """Score every candidate against a profile (genres, top_artists, user_id)"""
+        genre_words = word_vector(profile.get('genres', []))
+        tag_overlap = (self.tag_words @ genre_words)[self.tag_index]
+
+        top_artists = np.array([_hash(normalize(artist)) for artist in profile.get('top_artists', [])],
+                               dtype=np.uint32)
+        artist = np.isin(self.artist_hash, top_artists).astype(np.float32)
+
+        # Multiplicative hash of track identity and user gives stable per-user noise in [0, 1)
+        salt = np.uint32(_hash(str(profile.get('user_id') or "")))
+        jitter = ((self.identity ^ salt).astype(np.uint64) * np.uint64(2654435761) % np.uint64(2 ** 32)) / 2.0 ** 32
+
+        return (weights["tag_overlap"] * tag_overlap
+                + weights["artist"] * artist
+                + weights["tag_relevance"] * self.tag_relevance
+                + weights["popularity"] * self.popularity
+                + weights["playable"] * self.playable
+                + weights["jitter"] * jitter.astype(np.float32))
+
+    def rerank(self, scores, limit, artist_penalty=RANKING_ARTIST_PENALTY, tag_penalty=RANKING_TAG_PENALTY):
+        """Greedily pick `limit` candidates, discounting artists and tags already picked"""
+        scores = scores.astype(np.float64)
+        artist_picks = np.zeros(self.artist_index.max() + 1 if len(self) else 0)
+        tag_picks = np.zeros(len(self.tags))
+        available = np.ones(len(self), dtype=bool)
+        order = []
+
+        for _ in range(min(limit, len(self))):
+            adjusted = (scores - artist_penalty * artist_picks[self.artist_index]
+                        - tag_penalty * tag_picks[self.tag_index])
+            adjusted[~available] = -np.inf
+            best = int(np.argmax(adjusted))
+            order.append(best)
+            available[best] = False
+            artist_picks[self.artist_index[best]] += 1
+            tag_picks[self.tag_index[best]] += 1
+        return order
+
+    def rank(self, profile, limit, weights=RANKING_WEIGHTS):
+        """Return up to `limit` tracks, best first, diversified by artist and tag"""
+        if not len(self):
+            return []
+        return [self.tracks[i] for i in self.rerank(self.score(profile, weights), limit)]
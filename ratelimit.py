@@ -0,0 +1,292 @@
+import os
+import time
+import heapq
+import sqlite3
+import asyncio
+import logging
+import functools
+import itertools
+import threading
+import contextlib
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# Budgets per upstream as "requests per second[/burst]"; RATE_LIMIT_<NAME> overrides or adds one
+DEFAULT_LIMITS = {
+    "lastfm": "5/10",
+    "ytmusic": "4/8",
+    "spotify": "10/20",
+}
+
+# Bucket state lives in this SQLite file so every worker process draws from the same budget;
+# set it empty to keep budgets per process
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "ratelimit.db")
+# Longest a call waits for a token before failing
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+# Share of the burst that background work may not dip into, kept for interactive requests
+RATE_LIMIT_BACKGROUND_RESERVE = float(os.getenv("RATE_LIMIT_BACKGROUND_RESERVE", "0.5"))
+
+# Lower runs first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority = contextvars.ContextVar("rate_limit_priority", default=INTERACTIVE)
+
+
+class RateLimitExceeded(Exception):
+    """No token became available within the wait budget"""
+
+
+@contextlib.contextmanager
+def background():
+    """Mark calls made in this block (and work it fans out) as background priority"""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def is_background():
+    return _priority.get() >= BACKGROUND
+
+
+class MemoryBuckets:
+    """Token buckets for this process only"""
+
+    # Whether calls can block on I/O, so event-loop callers must make them from a thread
+    blocking = False
+
+    def __init__(self):
+        self._buckets = {}  # name -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    def take(self, name, rate, burst, cost, floor):
+        """Take cost tokens if at least floor would remain; else return seconds until they would"""
+        with self._lock:
+            now = time.time()
+            tokens, updated_at = self._buckets.get(name, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens - cost >= floor:
+                self._buckets[name] = [tokens - cost, now]
+                return 0.0
+            self._buckets[name] = [tokens, now]
+            return (floor + cost - tokens) / rate
+
+    def penalize(self, name, rate, burst, seconds):
+        """Empty the bucket so nothing is granted for the next `seconds`"""
+        with self._lock:
+            self._buckets[name] = [-seconds * rate, time.time()]
+
+    def level(self, name, rate, burst):
+        with self._lock:
+            tokens, updated_at = self._buckets.get(name, (burst, time.time()))
+        return min(burst, tokens + (time.time() - updated_at) * rate)
+
+
+class SQLiteBuckets(MemoryBuckets):
+    """Token buckets in a SQLite file shared by every process that opens it"""
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _read(self, name, burst, now):
+        row = self._conn.execute("SELECT tokens, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+        return row if row is not None else (burst, now)
+
+    def _write(self, name, tokens, now):
+        self._conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                           (name, tokens, now))
+
+    def take(self, name, rate, burst, cost, floor):
+        with self._lock:
+            # IMMEDIATE takes the write lock up front so read-modify-write is atomic across processes
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                tokens, updated_at = self._read(name, burst, now)
+                tokens = min(burst, tokens + (now - updated_at) * rate)
+                granted = tokens - cost >= floor
+                self._write(name, tokens - cost if granted else tokens, now)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return 0.0 if granted else (floor + cost - tokens) / rate
+
+    def penalize(self, name, rate, burst, seconds):
+        with self._lock:
+            self._write(name, -seconds * rate, time.time())
+
+    def level(self, name, rate, burst):
+        with self._lock:
+            now = time.time()
+            tokens, updated_at = self._read(name, burst, now)
+        return min(burst, tokens + (now - updated_at) * rate)
+
+
+class RateLimiter:
+    """Client-side pacing for one upstream.
+
+    Waiters in this process are served in priority order, then arrival
+    order. Background callers also leave a reserve of the burst untouched,
+    which keeps that ordering across processes sharing the store.
+    """
+
+    def __init__(self, name, rate, burst, store, max_wait=RATE_LIMIT_MAX_WAIT,
+                 background_reserve=RATE_LIMIT_BACKGROUND_RESERVE):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.store = store
+        self.max_wait = max_wait
+        self.background_reserve = background_reserve
+        self._waiters = []  # heap of (priority, sequence)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self.granted = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+
+    def _floor(self, priority):
+        return self.burst * self.background_reserve if priority >= BACKGROUND else 0.0
+
+    def _granted(self, started_at):
+        self.granted += 1
+        self.waited_seconds += time.monotonic() - started_at
+
+    def _rejected(self):
+        self.rejected += 1
+        return RateLimitExceeded(f"No {self.name} budget within {self.max_wait}s")
+
+    def acquire(self, cost=1, priority=None, timeout=None):
+        """Block until cost tokens are granted; raises RateLimitExceeded after timeout"""
+        priority = _priority.get() if priority is None else priority
+        started_at = time.monotonic()
+        deadline = started_at + (self.max_wait if timeout is None else timeout)
+        entry = (priority, next(self._sequence))
+
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                with self._cond:
+                    is_head = self._waiters[0] == entry
+                wait = None
+                if is_head:
+                    # Outside the condition: a shared store can wait seconds for its write lock,
+                    # and other threads must still be able to queue behind us meanwhile
+                    wait = self.store.take(self.name, self.rate, self.burst, cost, self._floor(priority))
+                    if wait == 0:
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._rejected()
+                with self._cond:
+                    # Became head while taking was going on elsewhere; try right away
+                    if not is_head and self._waiters[0] == entry:
+                        continue
+                    # Sleep until tokens refill, or until a waiter ahead of us finishes
+                    self._cond.wait(remaining if wait is None else min(wait, remaining))
+        finally:
+            with self._cond:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+        self._granted(started_at)
+
+    async def acquire_async(self, cost=1, priority=None, timeout=None):
+        """acquire() for event-loop callers; paced by the shared bucket only"""
+        priority = _priority.get() if priority is None else priority
+        started_at = time.monotonic()
+        deadline = started_at + (self.max_wait if timeout is None else timeout)
+
+        while True:
+            # A shared store takes a cross-process write lock that can wait for seconds
+            take = functools.partial(self.store.take, self.name, self.rate, self.burst, cost, self._floor(priority))
+            wait = await asyncio.to_thread(take) if self.store.blocking else take()
+            if wait == 0:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._rejected()
+            await asyncio.sleep(min(wait, remaining))
+
+        self._granted(started_at)
+
+    def throttle(self, seconds):
+        """The upstream answered 429: hold every process off for `seconds`"""
+        self.throttled += 1
+        self.store.penalize(self.name, self.rate, self.burst, seconds)
+        logger.warning(f"{self.name} rate limited upstream, pausing for {seconds:.1f}s")
+
+    async def throttle_async(self, seconds):
+        """throttle() for event-loop callers"""
+        if self.store.blocking:
+            await asyncio.to_thread(self.throttle, seconds)
+        else:
+            self.throttle(seconds)
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": round(self.store.level(self.name, self.rate, self.burst), 2),
+            "waiting": len(self._waiters),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "throttled": self.throttled,
+            "waited_seconds": round(self.waited_seconds, 3)
+        }
+
+
+def parse_limit(spec):
+    """'5/10' -> (5.0, 10.0); burst defaults to one second's worth"""
+    rate, _, burst = spec.partition("/")
+    rate = float(rate)
+    return rate, float(burst) if burst else max(rate, 1.0)
+
+
+_store = None
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _get_store():
+    global _store
+    if _store is None:
+        try:
+            _store = SQLiteBuckets(RATE_LIMIT_DB) if RATE_LIMIT_DB else MemoryBuckets()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to open rate limit store {RATE_LIMIT_DB}, using per-process budgets: {str(e)}")
+            _store = MemoryBuckets()
+    return _store
+
+
+def limiter(name):
+    """Return the process-wide limiter for an upstream, or None when it has no budget"""
+    if name is None:
+        return None
+    if name in _limiters:
+        return _limiters[name]
+
+    with _limiters_lock:
+        if name not in _limiters:
+            spec = os.getenv(f"RATE_LIMIT_{name.upper()}", DEFAULT_LIMITS.get(name, ""))
+            _limiters[name] = RateLimiter(name, *parse_limit(spec), _get_store()) if spec else None
+        return _limiters[name]
+
+
+def stats():
+    return {name: upstream.stats() for name, upstream in _limiters.items() if upstream is not None}
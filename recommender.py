@@ -0,0 +1,512 @@
+import os
+import logging
+import threading
+
+from ytmusicapi import YTMusic
+
+import llm
+import http_client
+import metrics
+import ratelimit
+import spotify_api
+from caching import TieredCache, TTLCache
+from fanout import Deadline, fan_out, iter_completed, submit
+from pools import CandidatePools
+from ranking import RANKING_WEIGHTS, CandidateSet
+from session_state import RecommendationState
+from singleflight import SingleFlight
+from yt_index import VideoIndex, normalize
+
+logger = logging.getLogger(__name__)
+
+LASTFM_API_KEY = os.getenv("LASTFM_API_KEY", "894c8fa3285772930a82e00d410c5fd3")
+LASTFM_URL = os.getenv("LASTFM_URL", "http://ws.audioscrobbler.com/2.0/")
+
+# Optional JSON search endpoint used instead of ytmusicapi (benchmark stand-ins)
+YT_SEARCH_URL = os.getenv("YT_SEARCH_URL")
+
+# Per-call timeouts (seconds) and the overall budget for one recommendation request
+LASTFM_TIMEOUT = float(os.getenv("LASTFM_TIMEOUT", "5"))
+YT_TIMEOUT = float(os.getenv("YT_TIMEOUT", "5"))
+RECOMMENDATION_DEADLINE = float(os.getenv("RECOMMENDATION_DEADLINE", "20"))
+
+# Tags used per request, tracks per tag, and how many tracks get a YouTube link
+TAGS_PER_REQUEST = 3
+TRACKS_PER_TAG = 5
+YT_RESOLVE_LIMIT = 10
+
+# "eager" resolves links for the first YT_RESOLVE_LIMIT tracks before a response completes;
+# "lazy" returns tracks right away and leaves links to POST /resolve as the player needs them
+YT_RESOLVE_MODES = ("eager", "lazy")
+YT_RESOLVE_MODE = os.getenv("YT_RESOLVE_MODE", "eager")
+# Most tracks one /resolve call accepts, and its time budget
+YT_RESOLVE_BATCH_MAX = int(os.getenv("YT_RESOLVE_BATCH_MAX", "25"))
+YT_RESOLVE_DEADLINE = float(os.getenv("YT_RESOLVE_DEADLINE", "10"))
+
+# Candidates fetched per tag for ranking, and how many ranked tracks a response keeps
+RANK_CANDIDATES_PER_TAG = int(os.getenv("RANK_CANDIDATES_PER_TAG", "20"))
+RECOMMENDATION_SIZE = TAGS_PER_REQUEST * TRACKS_PER_TAG
+
+# Last.fm response cache; set LASTFM_CACHE_DB to a file path to keep it across restarts
+LASTFM_CACHE_SIZE = int(os.getenv("LASTFM_CACHE_SIZE", "2048"))
+LASTFM_CACHE_TTL = float(os.getenv("LASTFM_CACHE_TTL", "3600"))
+LASTFM_CACHE_DISK_TTL = float(os.getenv("LASTFM_CACHE_DISK_TTL", "86400"))
+LASTFM_CACHE_DB = os.getenv("LASTFM_CACHE_DB")
+
+# Candidate pools precomputed per emotion in the background. They cost upstream and LLM traffic,
+# so they stay off until POOL_SEED_EMOTIONS lists moods to keep warm (e.g. "happy,sad,calm");
+# POOL_REFRESH_INTERVAL=0 also disables them
+POOL_REFRESH_INTERVAL = float(os.getenv("POOL_REFRESH_INTERVAL", "600"))
+POOL_MAX_AGE = float(os.getenv("POOL_MAX_AGE", "1800"))
+POOL_TOP_EMOTIONS = int(os.getenv("POOL_TOP_EMOTIONS", "12"))
+POOL_SEED_EMOTIONS = [emotion for emotion in os.getenv("POOL_SEED_EMOTIONS", "").split(",") if emotion.strip()]
+POOL_TAGS = int(os.getenv("POOL_TAGS", "6"))
+POOL_TRACKS_PER_TAG = int(os.getenv("POOL_TRACKS_PER_TAG", "25"))
+POOL_BUILD_DEADLINE = float(os.getenv("POOL_BUILD_DEADLINE", "300"))
+
+# Per-listener state reused by feedback rounds: sessions kept, idle expiry, and the tag_relevance
+# weight used while feedback is shifting the mood so the newest tags lead
+SESSION_STATE_MAX = int(os.getenv("SESSION_STATE_MAX", "1024"))
+SESSION_STATE_TTL = float(os.getenv("SESSION_STATE_TTL", "3600"))
+FEEDBACK_TAG_RELEVANCE = float(os.getenv("FEEDBACK_TAG_RELEVANCE", "1.5"))
+
+TAGS_SYSTEM_PROMPT = ("You are a music recommendation expert. "
+                      'Respond ONLY with JSON of the form {"tags": ["tag", ...]} listing emotion-related tags.')
+TAGS_SCHEMA = {
+    "type": "object",
+    "properties": {"tags": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 1}},
+    "required": ["tags"]
+}
+
+lastfm = http_client.session("lastfm", read_timeout=LASTFM_TIMEOUT)
+
+lastfm_cache = TieredCache(
+    maxsize=LASTFM_CACHE_SIZE,
+    ttl=LASTFM_CACHE_TTL,
+    path=LASTFM_CACHE_DB,
+    disk_ttl=LASTFM_CACHE_DISK_TTL,
+    table="lastfm"
+)
+
+# Concurrent identical upstream calls share one request
+lastfm_flight = SingleFlight("lastfm")
+ytmusic_flight = SingleFlight("ytmusic")
+
+# Track -> videoId index in front of yt.search; YT_INDEX_PRELOAD seeds it from a file
+video_index = VideoIndex()
+if os.getenv("YT_INDEX_PRELOAD"):
+    try:
+        video_index.preload(os.getenv("YT_INDEX_PRELOAD"))
+    except Exception as e:
+        logger.error(f"Failed to preload YouTube index: {str(e)}")
+
+# Initialize YouTube Music API
+try:
+    # YTMusic searches are POSTs but safe to repeat
+    yt = YTMusic(requests_session=http_client.session(
+        "ytmusic", read_timeout=YT_TIMEOUT, retry_methods=frozenset({"GET", "POST"})))
+except Exception as e:
+    logger.error(f"Failed to initialize YTMusic: {str(e)}")
+    yt = None
+
+yt_search = http_client.session("ytsearch", read_timeout=YT_TIMEOUT) if YT_SEARCH_URL else None
+search_enabled = bool(yt or yt_search)
+
+session_states = TTLCache(maxsize=SESSION_STATE_MAX, ttl=SESSION_STATE_TTL)
+_session_states_lock = threading.Lock()
+
+
+class RecommendationError(Exception):
+    """Pipeline failure that maps onto an HTTP error response"""
+
+    def __init__(self, status_code, error, detail=None):
+        super().__init__(error)
+        self.status_code = status_code
+        self.error = error
+        self.detail = detail
+
+
+def tag_cache_key(tag, limit):
+    return ("tag.gettoptracks", tag.strip().lower(), limit)
+
+
+def tag_params(tag, limit):
+    return {
+        "method": "tag.gettoptracks",
+        "tag": tag,
+        "api_key": LASTFM_API_KEY,
+        "format": "json",
+        "limit": limit
+    }
+
+
+def parse_tag_tracks(tag, data):
+    """Turn a tag.gettoptracks body into track/artist dicts, or None on an API error"""
+    if 'error' in data:
+        logger.warning(f"Last.fm error for tag {tag}: {data.get('message')}")
+        return None
+
+    return [
+        {"track": track.get('name'), "artist": track.get('artist', {}).get('name')}
+        for track in data.get('tracks', {}).get('track', [])
+    ]
+
+
+def fetch_tag_tracks(tag, limit):
+    """Fetch the top tracks for a Last.fm tag as track/artist dicts"""
+    cache_key = tag_cache_key(tag, limit)
+    cached = lastfm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    return lastfm_flight.do(cache_key, _fetch_tag_tracks, tag, limit, cache_key)
+
+
+def _fetch_tag_tracks(tag, limit, cache_key):
+    with metrics.span("lastfm"):
+        response = lastfm.get(LASTFM_URL, params=tag_params(tag, limit))
+
+    if response.status_code != 200:
+        logger.warning(f"Last.fm error for tag {tag}: {response.status_code}")
+        return []
+
+    tracks = parse_tag_tracks(tag, response.json())
+    if tracks is None:
+        return []
+
+    lastfm_cache.set(cache_key, tracks)
+    return tracks
+
+
+def search_video_id(track, artist):
+    """Return the videoId of the first video search result, or None"""
+    with metrics.span("ytmusic"):
+        if yt_search:
+            response = yt_search.get(YT_SEARCH_URL, params={"q": f"{track} {artist}"})
+            response.raise_for_status()
+            results = response.json()
+        else:
+            results = yt.search(f"{track} {artist}")
+    for item in results:
+        if item["resultType"] == "video":
+            return item['videoId']
+    return None
+
+
+def yt_link(video_id):
+    return f"https://music.youtube.com/watch?v={video_id}" if video_id else None
+
+
+def cached_yt_link(track, artist, memory_only=False):
+    """Return (found, link) from the index alone, without searching"""
+    found, video_id = video_index.lookup(artist, track, memory_only)
+    return found, yt_link(video_id)
+
+
+def resolve_yt_link(track, artist):
+    """Return a YouTube Music link for a track, using the index before searching"""
+    found, video_id = video_index.lookup(artist, track)
+    if not found:
+        if not search_enabled:
+            return None
+        key = (normalize(artist or ""), normalize(track or ""))
+        video_id = ytmusic_flight.do(key, _search_and_store, track, artist)
+
+    return yt_link(video_id)
+
+
+def _search_and_store(track, artist):
+    video_id = search_video_id(track, artist)
+    video_index.store(artist, track, video_id)
+    return video_id
+
+
+def resolve_yt_links(tracks, deadline=None):
+    """Resolve a batch of track/artist dicts in parallel; False marks lookups the deadline cut off"""
+    deadline = deadline or Deadline(YT_RESOLVE_DEADLINE)
+    with metrics.span("resolve"):
+        return fan_out(lambda track: resolve_yt_link(track.get('track'), track.get('artist')), tracks,
+                       deadline, default=False)
+
+
+def check_resolve_mode(resolve):
+    if resolve not in YT_RESOLVE_MODES:
+        raise RecommendationError(400, f"Unknown resolve mode: {resolve}",
+                                  f"Use one of {', '.join(YT_RESOLVE_MODES)}")
+
+
+def generate_tags(emotion, genres, country):
+    """Ask the LLM for music tags matching an emotion and the user's taste"""
+    prompt = f"""
+        For the emotion "{emotion}", and considering these genres: {', '.join(genres)}
+        and country: {country}, generate 5 music tags.
+        """
+    with metrics.span("llm_tags"):
+        return complete_tags(prompt)
+
+
+def complete_tags(prompt):
+    # A plain comma-separated answer is still usable when no valid JSON comes back
+    result = llm.complete_json(TAGS_SYSTEM_PROMPT, prompt, TAGS_SCHEMA, "tags",
+                               fallback=lambda content: {"tags": parse_tags(content)})
+    return [tag.strip() for tag in result["tags"] if tag.strip()]
+
+
+def parse_tags(response):
+    return [tag.strip() for tag in response.split(",") if tag.strip()]
+
+
+def collect_candidates(tags, tag_tracks):
+    """Flatten per-tag Last.fm results into candidates with their tag and rank in it.
+
+    The same song can top several tags; only its first appearance is kept.
+    """
+    tracks = []
+    seen = set()
+    for tag, candidates in zip(tags, tag_tracks):
+        for rank, track in enumerate(candidates or []):
+            key = (normalize(track['artist'] or ""), normalize(track['track'] or ""))
+            if key not in seen:
+                seen.add(key)
+                tracks.append({**track, "tag": tag, "rank": rank})
+    return tracks
+
+
+def rank_candidates(tags, tag_tracks, profile, limit=RECOMMENDATION_SIZE):
+    """Score live candidates for a user, filling in YouTube links the index already knows"""
+    tracks = collect_candidates(tags, tag_tracks)
+    for track in tracks:
+        found, link = cached_yt_link(track['track'], track['artist'])
+        if found:
+            track["yt_link"] = link
+
+    with metrics.span("rank"):
+        return CandidateSet(tracks, tags).rank(profile, limit)
+
+
+def build_pool(emotion):
+    """Precompute tags, tracks and YouTube links for an emotion, independent of any user"""
+    # Warming runs behind interactive requests for upstream rate-limit budget
+    with ratelimit.background():
+        return _build_pool(emotion)
+
+
+def _build_pool(emotion):
+    deadline = Deadline(POOL_BUILD_DEADLINE)
+    prompt = f"""
+        For the emotion "{emotion}", generate {POOL_TAGS} music tags.
+        """
+    with metrics.span("llm_pool_tags"):
+        tags = complete_tags(prompt)[:POOL_TAGS]
+    if not tags:
+        return None
+
+    tag_tracks = fan_out(lambda tag: fetch_tag_tracks(tag, POOL_TRACKS_PER_TAG), tags, deadline, default=[])
+    tracks = collect_candidates(tags, tag_tracks)
+    if not tracks:
+        return None
+
+    # Lookups that failed or ran out of time stay unknown rather than being stored as missing
+    links = fan_out(lambda track: resolve_yt_link(track['track'], track['artist']), tracks, deadline,
+                    default=False)
+    for track, link in zip(tracks, links):
+        if link is not False:
+            track["yt_link"] = link
+
+    # Feature arrays are built once here so each request only scores
+    return CandidateSet(tracks, tags)
+
+
+def pool_events(pool, emotion, profile, state=None):
+    """Yield the same events as the live pipeline, ranked for one user from a warm pool"""
+    with metrics.span("pool_rank"):
+        tracks = pool.rank(profile, RECOMMENDATION_SIZE)
+    tag_tracks = [[track for track in pool.tracks if track['tag'] == tag] for tag in pool.tags]
+    remember_round(state, emotion, profile, pool.tags, tag_tracks, tracks)
+
+    yield {"event": "tags", "tags": pool.tags, "emotion": emotion,
+           "genres": profile['genres'], "country": profile['country']}
+
+    for index, track in enumerate(tracks):
+        yield {"event": "track", "index": index, "track": track['track'], "artist": track['artist'],
+               "tag": track['tag']}
+    for index, track in enumerate(tracks):
+        if track.get('yt_link'):
+            yield {"event": "yt_link", "index": index, "yt_link": track['yt_link']}
+    yield {"event": "done", "count": len(tracks)}
+
+
+candidate_pools = CandidatePools(
+    build_pool,
+    refresh_interval=POOL_REFRESH_INTERVAL,
+    max_age=POOL_MAX_AGE,
+    top_n=POOL_TOP_EMOTIONS,
+    seeds=POOL_SEED_EMOTIONS
+) if POOL_REFRESH_INTERVAL > 0 and POOL_SEED_EMOTIONS else None
+
+
+def session_state(key):
+    """Get or start the recommendation state for one listener session"""
+    with _session_states_lock:
+        state = session_states.get(key)
+        if state is None:
+            state = RecommendationState(RANKING_WEIGHTS)
+        # Every use pushes the idle expiry back
+        session_states.set(key, state)
+    return state
+
+
+def remember_round(state, emotion, profile, tags, tag_tracks, tracks):
+    """Seed a session's state from a full pipeline run so feedback rounds can build on it"""
+    if state is None:
+        return
+    with state.lock:
+        state.begin(emotion, profile, tags, tag_tracks)
+        state.record_links(tracks)
+        state.mark_recommended(tracks)
+
+
+def warm_pool(emotion):
+    """Count demand for an emotion and return its warm pool, or None"""
+    if candidate_pools is None:
+        return None
+    candidate_pools.record(emotion)
+    return candidate_pools.get(emotion)
+
+
+def recommendation_events(access_token, emotion, deadline=None, resolve=YT_RESOLVE_MODE, state=None):
+    """Run the recommendation pipeline, yielding events as each stage produces them.
+
+    Events, in order: one "tags" event, a "track" event per track (indexes in
+    final playlist order), "yt_link" events as links resolve, and "done".
+    With resolve="lazy" only links already known are sent; the rest are left
+    to /resolve. A session `state` is reset to what this run found. Raises
+    RecommendationError for failures that leave nothing to return.
+    """
+    check_resolve_mode(resolve)
+    deadline = deadline or Deadline(RECOMMENDATION_DEADLINE)
+
+    # Step 1: Get user data (cached per token for the session)
+    try:
+        profile = spotify_api.get_profile(access_token)
+    except spotify_api.SpotifyError as e:
+        raise RecommendationError(e.status_code, "Failed to get user profile", e.detail)
+
+    # Common moods are served from a precomputed pool, skipping the LLM and upstream lookups
+    pool = warm_pool(emotion)
+    if pool:
+        yield from pool_events(pool, emotion, profile, state)
+        return
+
+    country = profile['country']
+    genres = profile['genres']
+
+    # Step 2: Generate emotion tags
+    tags = generate_tags(emotion, genres, country)
+    if not tags:
+        raise RecommendationError(500, "Failed to generate tags")
+
+    yield {"event": "tags", "tags": tags, "emotion": emotion, "genres": genres, "country": country}
+
+    # Step 3: Look up every tag on Last.fm in parallel and rank the combined candidates
+    selected_tags = tags[:TAGS_PER_REQUEST]
+    tag_tracks = fan_out(lambda tag: fetch_tag_tracks(tag, RANK_CANDIDATES_PER_TAG), selected_tags,
+                         deadline, default=[])
+    tracks = rank_candidates(selected_tags, tag_tracks, profile)
+    if not tracks:
+        raise RecommendationError(404, "No tracks found for these tags")
+    remember_round(state, emotion, profile, selected_tags, tag_tracks, tracks)
+
+    link_futures = {}
+    for index, track in enumerate(tracks):
+        yield {"event": "track", "index": index, "track": track['track'], "artist": track['artist'],
+               "tag": track['tag']}
+        if resolve == "eager" and index < YT_RESOLVE_LIMIT and 'yt_link' not in track and search_enabled:
+            link_futures[index] = submit(resolve_yt_link, track['track'], track['artist'])
+
+    # Step 4: Emit known YouTube links, then the rest as they resolve
+    for index, track in enumerate(tracks):
+        if track.get('yt_link'):
+            yield {"event": "yt_link", "index": index, "yt_link": track['yt_link']}
+    for track_index, link in iter_completed(link_futures, deadline):
+        if link:
+            yield {"event": "yt_link", "index": track_index, "yt_link": link}
+
+    yield {"event": "done", "count": len(tracks)}
+
+
+def apply_event(body, event):
+    """Fold one pipeline event into a /get_recommendations response body"""
+    if event["event"] == "tags":
+        body.update(emotion=event["emotion"], genres=event["genres"], country=event["country"])
+    elif event["event"] == "track":
+        body["recommendations"].append({"track": event["track"], "artist": event["artist"], "tag": event["tag"]})
+    elif event["event"] == "yt_link":
+        body["recommendations"][event["index"]]["yt_link"] = event["yt_link"]
+    return body
+
+
+def get_recommendations(access_token, emotion, resolve=YT_RESOLVE_MODE, state=None):
+    """Collect the pipeline events into the /get_recommendations response body"""
+    body = {"recommendations": []}
+    for event in recommendation_events(access_token, emotion, resolve=resolve, state=state):
+        apply_event(body, event)
+    return body
+
+
+def feedback_recommendations(state, tags, access_token, mood_adjustment="no_change", played=(),
+                             limit=RECOMMENDATION_SIZE):
+    """Apply one feedback round to a session's state and return fresh recommendations.
+
+    Only tags new to the session are looked up on Last.fm and only picked
+    tracks without a known link are searched; the profile, candidates and
+    links from earlier rounds are reused. Played tracks are not offered again.
+    Without a state the round starts from scratch and nothing is kept.
+    The state's lock is held only to read and merge, never across lookups.
+    """
+    if state is None and not access_token:
+        raise RecommendationError(400, "Missing access_token or session_id")
+    state = state or RecommendationState(RANKING_WEIGHTS)
+    deadline = Deadline(RECOMMENDATION_DEADLINE)
+
+    # Step 1: Apply the tag change and take a snapshot to work on
+    with state.lock:
+        added, removed = state.set_tags(tags)
+        state.mark_played(played)
+        # While the mood is shifting, let the newest tags (listed first) lead the ranking
+        state.weights["tag_relevance"] = (RANKING_WEIGHTS["tag_relevance"] if mood_adjustment == "no_change"
+                                          else FEEDBACK_TAG_RELEVANCE)
+        round_state = state.snapshot()
+
+    profile = round_state.profile or spotify_api.get_profile(access_token)
+
+    # Step 2: Look up only the tags this session has no candidates for
+    missing = round_state.missing_tags()
+    fetched = fan_out(lambda tag: fetch_tag_tracks(tag, RANK_CANDIDATES_PER_TAG), missing, deadline, default=[])
+    new_candidates = {tag: tracks for tag, tracks in zip(missing, fetched) if tracks}
+    round_state.candidates.update(new_candidates)
+
+    # Step 3: Rank the unplayed candidates of the active tags with the session's weights
+    candidates = round_state.fresh(collect_candidates(round_state.tags, round_state.tag_tracks()), limit)
+    for track in round_state.apply_links(candidates):
+        found, link = cached_yt_link(track['track'], track['artist'])
+        if found:
+            track["yt_link"] = link
+    with metrics.span("rank"):
+        tracks = CandidateSet(candidates, round_state.tags).rank(profile, limit, round_state.weights)
+
+    # Step 4: Search links only for picked tracks nobody has resolved yet
+    unknown = [track for track in tracks if 'yt_link' not in track]
+    links = fan_out(lambda track: resolve_yt_link(track['track'], track['artist']), unknown, deadline,
+                    default=False)
+    for track, link in zip(unknown, links):
+        if link is not False:
+            track["yt_link"] = link
+
+    with state.lock:
+        state.merge(profile, new_candidates, tracks)
+
+    logger.info(f"Feedback round {state.rounds}: {len(added)} tags added, {len(removed)} removed, "
+                f"{len(missing)} fetched, {len(unknown)} links searched")
+    return [{"track": track['track'], "artist": track['artist'], "tag": track['tag'],
+             "yt_link": track.get('yt_link')} for track in tracks]
@@ -0,0 +1,139 @@
+import time
+import threading
+from collections import deque
+
+from yt_index import normalize
+
+# Inactive tags whose Last.fm candidates stay cached, so a tag that comes back costs nothing
+MAX_INACTIVE_TAGS = 12
+# Feedback turns kept for the LLM's context, and tag rounds kept for inspection
+MAX_FEEDBACK_TURNS = 4
+MAX_TAG_ROUNDS = 20
+
+
+def normalize_tag(tag):
+    return " ".join(tag.lower().split())
+
+
+def track_key(track):
+    return normalize(track.get('artist') or ""), normalize(track.get('track') or "")
+
+
+class RecommendationState:
+    """What one listener's session has found so far, updated in place by each round.
+
+    Holds the profile, the active tags (most relevant first) and their
+    Last.fm candidates, links already resolved, tracks already recommended
+    or played, ranking weights and a short feedback history. Callers hold
+    `lock` while reading and updating it.
+    """
+
+    def __init__(self, weights):
+        self.lock = threading.Lock()
+        self.emotion = None
+        self.profile = None
+        self.tags = []
+        self.candidates = {}  # tag -> Last.fm tracks, active and recently dropped tags
+        self.links = {}  # track_key -> YouTube link, None when known missing
+        self.recommended = set()
+        self.played = set()
+        self.weights = dict(weights)
+        self.tag_history = deque(maxlen=MAX_TAG_ROUNDS)  # per round: {"tags", "added", "removed"}
+        self.feedback = deque(maxlen=MAX_FEEDBACK_TURNS)
+        self.rounds = 0
+        self.updated_at = time.time()
+
+    def begin(self, emotion, profile, tags, tag_tracks):
+        """Start over from a full pipeline run for a new emotion"""
+        self.emotion = emotion
+        self.profile = profile
+        self.recommended.clear()
+        self.candidates.update((normalize_tag(tag), tracks) for tag, tracks in zip(tags, tag_tracks) if tracks)
+        self.set_tags(tags)
+
+    def set_tags(self, tags):
+        """Make `tags` the active tags; returns (added, removed) against the previous round"""
+        tags = list(dict.fromkeys(normalize_tag(tag) for tag in tags if tag.strip()))
+        added = [tag for tag in tags if tag not in self.tags]
+        removed = [tag for tag in self.tags if tag not in tags]
+        self.tags = tags
+        self.tag_history.append({"tags": tags, "added": added, "removed": removed})
+        self.rounds += 1
+        self.updated_at = time.time()
+
+        inactive = [tag for tag in self.candidates if tag not in tags]
+        for tag in inactive[:max(0, len(inactive) - MAX_INACTIVE_TAGS)]:
+            del self.candidates[tag]
+        return added, removed
+
+    def missing_tags(self):
+        """Active tags with no candidates fetched yet"""
+        return [tag for tag in self.tags if tag not in self.candidates]
+
+    def tag_tracks(self):
+        return [self.candidates.get(tag, []) for tag in self.tags]
+
+    def record_links(self, tracks):
+        for track in tracks:
+            if 'yt_link' in track:
+                self.links[track_key(track)] = track['yt_link']
+
+    def apply_links(self, tracks):
+        """Fill in links this session already resolved; returns the tracks still unknown"""
+        unknown = []
+        for track in tracks:
+            key = track_key(track)
+            if key in self.links:
+                track['yt_link'] = self.links[key]
+            elif 'yt_link' not in track:
+                unknown.append(track)
+        return unknown
+
+    def mark_recommended(self, tracks):
+        self.recommended.update(track_key(track) for track in tracks)
+
+    def mark_played(self, tracks):
+        self.played.update(track_key(track) for track in tracks)
+
+    def fresh(self, tracks, limit):
+        """Tracks not played, preferring ones not recommended yet; topped up to `limit` with repeats"""
+        unplayed = [track for track in tracks if track_key(track) not in self.played]
+        unseen = [track for track in unplayed if track_key(track) not in self.recommended]
+        if len(unseen) >= limit:
+            return unseen
+        return unseen + [track for track in unplayed if track_key(track) in self.recommended]
+
+    def snapshot(self):
+        """Detached copy for work done without holding `lock`; merge results back with merge()"""
+        copy = RecommendationState(self.weights)
+        copy.emotion = self.emotion
+        copy.profile = self.profile
+        copy.tags = list(self.tags)
+        copy.candidates = dict(self.candidates)
+        copy.links = dict(self.links)
+        copy.recommended = set(self.recommended)
+        copy.played = set(self.played)
+        return copy
+
+    def merge(self, profile, candidates, tracks):
+        """Fold what a round found without the lock back in; call with `lock` held"""
+        if self.profile is None:
+            self.profile = profile
+        for tag, tracks_for_tag in candidates.items():
+            # Tags dropped by a newer round meanwhile are not brought back
+            if tag in self.tags:
+                self.candidates[tag] = tracks_for_tag
+        self.record_links(tracks)
+        self.mark_recommended(tracks)
+        self.updated_at = time.time()
+
+    def summary(self):
+        return {
+            "emotion": self.emotion,
+            "tags": self.tags,
+            "rounds": self.rounds,
+            "cached_tags": len(self.candidates),
+            "known_links": len(self.links),
+            "recommended": len(self.recommended),
+            "played": len(self.played)
+        }
@@ -0,0 +1,357 @@
+import os
+import time
+import secrets
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import http_client
+import metrics
+from caching import TTLCache
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Overridable so benchmarks can point at local stand-ins
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+
+TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+PROFILE_URL = f"{SPOTIFY_API_URL}/v1/me"
+TOP_ARTISTS_URL = f"{SPOTIFY_API_URL}/v1/me/top/artists?time_range=medium_term&limit=5"
+
+# Profiles are cached per access token and never outlive the token itself
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "4096"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "3600"))
+
+# Server-side sessions, kept in this SQLite file so every worker process and restart sees them;
+# it holds refresh tokens, so keep it private. Set it empty to keep sessions in memory.
+SPOTIFY_SESSION_DB = os.getenv("SPOTIFY_SESSION_DB", "spotify_sessions.db")
+# Access tokens are refreshed in the background SPOTIFY_REFRESH_AHEAD seconds before expiry
+# while the session has been used within SPOTIFY_SESSION_IDLE
+SPOTIFY_SESSION_MAX = int(os.getenv("SPOTIFY_SESSION_MAX", "10000"))
+SPOTIFY_REFRESH_AHEAD = float(os.getenv("SPOTIFY_REFRESH_AHEAD", "300"))
+SPOTIFY_REFRESH_CHECK_INTERVAL = float(os.getenv("SPOTIFY_REFRESH_CHECK_INTERVAL", "30"))
+SPOTIFY_SESSION_IDLE = float(os.getenv("SPOTIFY_SESSION_IDLE", "3600"))
+# A token this close to expiry is refreshed before use rather than handed out
+TOKEN_MIN_LIFETIME = 60
+# How long one process may hold a session's refresh before another may take it over
+REFRESH_CLAIM = 30
+# Seconds between last_used writes for one session
+LAST_USED_RESOLUTION = 60
+
+spotify = http_client.session("spotify")
+
+_profiles = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+_token_expiry = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+profile_flight = SingleFlight("spotify_profile")
+
+
+class SpotifyError(Exception):
+    """Non-200 answer from the Spotify Web API"""
+
+    def __init__(self, status_code, detail):
+        super().__init__(f"Spotify API error: {status_code} - {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+def token_key(access_token):
+    """Hash a token so raw credentials never become cache keys"""
+    return hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+
+
+def remember_token(access_token, expires_in):
+    """Record when a token expires so cached profiles expire with it"""
+    if access_token and expires_in:
+        _token_expiry.set(token_key(access_token), time.time() + expires_in, ttl=expires_in)
+
+
+def error_detail(response):
+    try:
+        error = response.json().get('error', {})
+    except ValueError:
+        return 'Unknown error'
+    if isinstance(error, dict):
+        return error.get('message', 'Unknown error')
+    return str(error)
+
+
+def cached_profile(access_token):
+    return _profiles.get(token_key(access_token))
+
+
+def build_profile(profile_data, top_artists):
+    """Shape /v1/me and top-artist items into the profile dict callers use"""
+    genres = set()
+    for artist in top_artists:
+        genres.update(artist.get("genres", []))
+
+    return {
+        "user_id": profile_data.get("id"),
+        "country": profile_data.get("country", "US"),
+        "genres": sorted(genres),
+        "top_artists": [artist["name"] for artist in top_artists]
+    }
+
+
+def cache_profile(access_token, profile):
+    """Cache a complete profile for the rest of the token's lifetime"""
+    key = token_key(access_token)
+    ttl = PROFILE_CACHE_TTL
+    expires_at = _token_expiry.get(key)
+    if expires_at is not None:
+        ttl = min(ttl, expires_at - time.time())
+    if ttl > 0:
+        _profiles.set(key, profile, ttl=ttl)
+
+
+def get_profile(access_token):
+    """Return country, genres and top artists for a user, cached per token"""
+    profile = cached_profile(access_token)
+    if profile is not None:
+        return profile
+
+    return profile_flight.do(token_key(access_token), _fetch_profile, access_token)
+
+
+def _fetch_profile(access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    with metrics.span("spotify_profile"):
+        response = spotify.get(PROFILE_URL, headers=headers)
+    if response.status_code != 200:
+        raise SpotifyError(response.status_code, error_detail(response))
+    profile_data = response.json()
+
+    with metrics.span("spotify_top_artists"):
+        response = spotify.get(TOP_ARTISTS_URL, headers=headers)
+    top_artists = []
+    if response.status_code == 200:
+        top_artists = response.json().get("items", [])
+    else:
+        logger.warning(f"Spotify top artists error: {response.status_code}")
+
+    profile = build_profile(profile_data, top_artists)
+
+    # Don't pin a profile with missing genres for the whole session
+    if response.status_code == 200:
+        cache_profile(access_token, profile)
+
+    return profile
+
+
+class TokenManager:
+    """Spotify tokens held server-side per session and refreshed before they expire.
+
+    Clients keep only the opaque session id. Sessions live in SQLite, so every
+    worker process sees the same ones and they survive restarts. Sessions
+    used recently are refreshed by a background thread ahead of expiry;
+    anything else is refreshed on its next use. One process at a time claims
+    a session's refresh, and concurrent refreshes within it share one call.
+    """
+
+    def __init__(self, client_id, client_secret, path=SPOTIFY_SESSION_DB, refresh_ahead=SPOTIFY_REFRESH_AHEAD,
+                 idle=SPOTIFY_SESSION_IDLE, check_interval=SPOTIFY_REFRESH_CHECK_INTERVAL,
+                 max_sessions=SPOTIFY_SESSION_MAX):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.path = path or ":memory:"
+        self.refresh_ahead = refresh_ahead
+        self.idle = idle
+        self.check_interval = check_interval
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._flight = SingleFlight("spotify_refresh")
+        self._thread = None
+        self.refreshes = 0
+        self.background_refreshes = 0
+        self.refresh_failures = 0
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS spotify_sessions (id TEXT PRIMARY KEY, access_token TEXT NOT NULL, "
+            "refresh_token TEXT, expires_at REAL NOT NULL, last_used REAL NOT NULL, "
+            "refreshing_until REAL NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS spotify_sessions_last_used ON spotify_sessions (last_used)")
+
+    def _store(self, session_id, tokens, refresh_token=None):
+        expires_in = tokens.get("expires_in") or 3600
+        remember_token(tokens["access_token"], expires_in)
+        now = time.time()
+        with self._lock:
+            # Spotify only sometimes rotates the refresh token; storing clears any refresh claim
+            self._conn.execute(
+                "INSERT INTO spotify_sessions (id, access_token, refresh_token, expires_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET access_token = excluded.access_token, "
+                "refresh_token = COALESCE(excluded.refresh_token, refresh_token), "
+                "expires_at = excluded.expires_at, refreshing_until = 0",
+                (session_id, tokens["access_token"], tokens.get("refresh_token") or refresh_token,
+                 now + expires_in, now)
+            )
+
+    def create(self, tokens):
+        """Store a token exchange response and return the new session id"""
+        session_id = secrets.token_urlsafe(32)
+        self._store(session_id, tokens)
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM spotify_sessions WHERE id IN "
+                "(SELECT id FROM spotify_sessions ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_sessions,)
+            )
+        self.start()
+        return session_id
+
+    def end(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM spotify_sessions WHERE id = ?", (session_id,))
+
+    def current(self, session_id):
+        """The session's access token if it is good for a while yet, else None; no network calls"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT access_token, expires_at, last_used FROM spotify_sessions WHERE id = ?",
+                                     (session_id,)).fetchone()
+            if row is None:
+                raise SpotifyError(401, "Unknown or expired session")
+            access_token, expires_at, last_used = row
+            # Idle tracking only needs coarse timestamps; skip the write on most requests
+            if now - last_used > LAST_USED_RESOLUTION:
+                self._conn.execute("UPDATE spotify_sessions SET last_used = ? WHERE id = ?", (now, session_id))
+
+        # Sessions created by another process or before a restart are refreshed here too
+        if self._thread is None:
+            self.start()
+        if expires_at - now > TOKEN_MIN_LIFETIME:
+            remember_token(access_token, expires_at - now)
+            return access_token
+        return None
+
+    def access_token(self, session_id):
+        """Return a usable access token for a session, refreshing first if needed"""
+        return self.current(session_id) or self.refresh(session_id)
+
+    def refresh(self, session_id, min_lifetime=TOKEN_MIN_LIFETIME):
+        return self._flight.do(session_id, self._refresh, session_id, min_lifetime)
+
+    def _claim_refresh(self, session_id, min_lifetime):
+        """Take the session's refresh for REFRESH_CLAIM seconds unless it is fresh or claimed; returns (row, claimed)"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT access_token, refresh_token, expires_at, refreshing_until FROM spotify_sessions "
+                    "WHERE id = ?", (session_id,)
+                ).fetchone()
+                claimed = row is not None and row[2] - now <= min_lifetime and row[3] < now
+                if claimed:
+                    self._conn.execute("UPDATE spotify_sessions SET refreshing_until = ? WHERE id = ?",
+                                       (now + REFRESH_CLAIM, session_id))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row, claimed
+
+    def _release_refresh(self, session_id):
+        with self._lock:
+            self._conn.execute("UPDATE spotify_sessions SET refreshing_until = 0 WHERE id = ?", (session_id,))
+
+    def _refresh(self, session_id, min_lifetime):
+        wait_until = time.monotonic() + REFRESH_CLAIM
+        while True:
+            row, claimed = self._claim_refresh(session_id, min_lifetime)
+            if row is None:
+                raise SpotifyError(401, "Unknown or expired session")
+            access_token, refresh_token, expires_at, _ = row
+            if claimed:
+                break
+            # Another process refreshed it already, or is doing so now
+            if expires_at - time.time() > min_lifetime:
+                return access_token
+            if time.monotonic() > wait_until:
+                raise SpotifyError(503, "Spotify token refresh still in progress")
+            time.sleep(0.2)
+
+        if not refresh_token:
+            self._release_refresh(session_id)
+            raise SpotifyError(401, "Unknown or expired session")
+
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret
+        }
+        try:
+            with metrics.span("spotify_refresh"):
+                response = spotify.post(TOKEN_URL, data=data)
+        except Exception:
+            self._release_refresh(session_id)
+            raise
+
+        if response.status_code != 200:
+            self.refresh_failures += 1
+            logger.warning(f"Spotify token refresh failed: {response.status_code}")
+            if response.status_code in (400, 401):
+                # The refresh token was revoked; only a new login can fix this session
+                self.end(session_id)
+                raise SpotifyError(401, "Spotify session revoked, please reconnect")
+            self._release_refresh(session_id)
+            raise SpotifyError(response.status_code, error_detail(response))
+
+        tokens = response.json()
+        self.refreshes += 1
+        self._store(session_id, tokens, refresh_token=refresh_token)
+        return tokens["access_token"]
+
+    def due(self):
+        """Recently used sessions whose tokens expire within refresh_ahead and nobody is refreshing"""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM spotify_sessions WHERE expires_at < ? AND last_used > ? AND refreshing_until < ?",
+                (now + self.refresh_ahead, now - self.idle, now)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                due = self.due()
+            except sqlite3.Error as e:
+                logger.error(f"Spotify session store error: {str(e)}")
+                continue
+            for session_id in due:
+                try:
+                    self.refresh(session_id, self.refresh_ahead)
+                    self.background_refreshes += 1
+                except Exception as e:
+                    logger.warning(f"Background token refresh failed: {str(e)}")
+
+    def start(self):
+        """Start the background refresher once per process"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="spotify-token-refresh", daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            sessions = self._conn.execute("SELECT COUNT(*) FROM spotify_sessions").fetchone()[0]
+        return {
+            "sessions": sessions,
+            "refreshes": self.refreshes,
+            "background_refreshes": self.background_refreshes,
+            "refresh_failures": self.refresh_failures
+        }
+
+
+def stats():
+    return _profiles.stats()
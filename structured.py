@@ -0,0 +1,147 @@
+import re
+import json
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL | re.IGNORECASE)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_DANGLING_KEY = re.compile(r'\s*,?\s*"(?:[^"\\]|\\.)*"\s*:\s*$')
+_DANGLING_COMMA = re.compile(r"\s*,\s*$")
+_LAST_STRING = re.compile(r'[{,]\s*"(?:[^"\\]|\\.)*"\s*$')
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+
+class OutputError(ValueError):
+    """Model output that could not be turned into JSON matching the schema"""
+
+    def __init__(self, message, content=""):
+        super().__init__(message)
+        self.content = content
+
+
+def close_truncated(text):
+    """Close the strings, arrays and objects left open by output cut off mid-value"""
+    closers = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]" and closers:
+            closers.pop()
+
+    if in_string:
+        text += '"'
+    # A key with no value, or a bare key, can't be completed; drop it
+    text = _DANGLING_KEY.sub("", text)
+    if closers and closers[-1] == "}":
+        match = _LAST_STRING.search(text)
+        if match:
+            text = text[:match.start() + 1]
+    text = _DANGLING_COMMA.sub("", text)
+    return text + "".join(reversed(closers))
+
+
+def _candidates(text, expect):
+    """Every JSON value of type `expect` in model output, in the order found"""
+    decoder = json.JSONDecoder()
+    opener = "{" if expect is dict else "["
+    sources = [match.group(1) for match in _FENCE.finditer(text)] + [text]
+
+    for source in sources:
+        for variant in dict.fromkeys((source, _TRAILING_COMMA.sub(r"\1", source))):
+            start = variant.find(opener)
+            while start != -1:
+                try:
+                    value, _ = decoder.raw_decode(variant, start)
+                    if isinstance(value, expect):
+                        yield value
+                except json.JSONDecodeError:
+                    pass
+                start = variant.find(opener, start + 1)
+
+            # Nothing closed: the answer may have hit the token limit
+            start = variant.find(opener)
+            if start != -1:
+                try:
+                    value = json.loads(_TRAILING_COMMA.sub(r"\1", close_truncated(variant[start:])))
+                    if isinstance(value, expect):
+                        yield value
+                except json.JSONDecodeError:
+                    pass
+
+
+def extract_json(text, expect=dict, schema=None):
+    """Find the first JSON value of type `expect` in model output, preferring one that fits `schema`.
+
+    Tolerates prose around the value, code fences, trailing commas and
+    output cut off before the value was closed. When nothing fits the
+    schema the first value found is returned for validation to report on.
+    """
+    first = None
+    for value in _candidates(text, expect):
+        if schema is None or not validate(value, schema):
+            return value
+        if first is None:
+            first = value
+    if first is not None:
+        return first
+    raise OutputError(f"No JSON {expect.__name__} found in model output")
+
+
+def validate(value, schema, path="$"):
+    """Check a value against the subset of JSON Schema used for prompts; returns a list of problems"""
+    expected = schema.get("type")
+    if expected:
+        # bool is an int subclass in Python but not in JSON
+        if not isinstance(value, _TYPES[expected]) or (expected in ("integer", "number")
+                                                       and isinstance(value, bool)):
+            return [f"{path} should be {expected}"]
+
+    problems = []
+    if "enum" in schema and value not in schema["enum"]:
+        problems.append(f"{path} should be one of {', '.join(map(str, schema['enum']))}")
+
+    if expected == "object":
+        for name in schema.get("required", []):
+            if name not in value:
+                problems.append(f"{path}.{name} is missing")
+        for name, subschema in schema.get("properties", {}).items():
+            if name in value:
+                problems.extend(validate(value[name], subschema, f"{path}.{name}"))
+
+    elif expected == "array":
+        if len(value) < schema.get("minItems", 0):
+            problems.append(f"{path} needs at least {schema['minItems']} items")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            problems.append(f"{path} allows at most {schema['maxItems']} items")
+        for i, item in enumerate(value):
+            problems.extend(validate(item, schema.get("items", {}), f"{path}[{i}]"))
+
+    elif expected == "string" and len(value.strip()) < schema.get("minLength", 0):
+        problems.append(f"{path} is empty")
+
+    return problems
+
+
+def parse(text, schema):
+    """Extract and validate a JSON answer; raises OutputError listing what is wrong"""
+    value = extract_json(text, dict if schema.get("type") == "object" else list, schema)
+    problems = validate(value, schema)
+    if problems:
+        raise OutputError("; ".join(problems))
+    return value
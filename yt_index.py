@@ -0,0 +1,95 @@
+import os
+import re
+import csv
+import json
+import logging
+import argparse
+import unicodedata
+
+from caching import TieredCache
+
+logger = logging.getLogger(__name__)
+
+# Resolved ids rarely change; misses are retried sooner in case the track gets uploaded.
+# An empty YT_INDEX_DB keeps the index in memory only.
+YT_INDEX_DB = os.getenv("YT_INDEX_DB", "yt_index.db")
+YT_INDEX_SIZE = int(os.getenv("YT_INDEX_SIZE", "50000"))
+YT_INDEX_TTL = float(os.getenv("YT_INDEX_TTL", str(30 * 86400)))
+YT_INDEX_NEGATIVE_TTL = float(os.getenv("YT_INDEX_NEGATIVE_TTL", str(86400)))
+
+_MISSING = object()
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text):
+    """Fold case, Unicode forms, punctuation and spacing so lookups match loosely"""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+class VideoIndex:
+    """Durable (artist, track) -> YouTube videoId index.
+
+    A stored videoId of None is a negative entry: the search found no video,
+    and it expires after the shorter negative TTL.
+    """
+
+    def __init__(self, path=YT_INDEX_DB, maxsize=YT_INDEX_SIZE, ttl=YT_INDEX_TTL,
+                 negative_ttl=YT_INDEX_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = TieredCache(maxsize=maxsize, ttl=ttl, path=path or None, table="yt_videos")
+
+    @staticmethod
+    def key(artist, track):
+        return normalize(artist), normalize(track)
+
+    def lookup(self, artist, track, memory_only=False):
+        """Return (found, video_id); video_id is None for a known miss"""
+        get = self.cache.get_memory if memory_only else self.cache.get
+        video_id = get(self.key(artist, track), _MISSING)
+        if video_id is _MISSING:
+            return False, None
+        return True, video_id
+
+    def store(self, artist, track, video_id):
+        ttl = self.ttl if video_id else self.negative_ttl
+        self.cache.set(self.key(artist, track), video_id, ttl=ttl, disk_ttl=ttl)
+
+    def preload(self, path):
+        """Bulk load artist/track/video_id rows from a CSV, TSV or JSON Lines file"""
+        entries = [(self.key(artist, track), video_id) for artist, track, video_id in _read_rows(path)
+                   if video_id]
+        self.cache.set_many(entries)
+        logger.info(f"Preloaded {len(entries)} YouTube ids from {path}")
+        return len(entries)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def _read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield row.get("artist"), row.get("track"), row.get("video_id")
+        else:
+            delimiter = "\t" if path.endswith(".tsv") else ","
+            for row in csv.DictReader(f, delimiter=delimiter):
+                yield row.get("artist"), row.get("track"), row.get("video_id")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Preload the YouTube video id index")
+    parser.add_argument("files", nargs="+", help="CSV/TSV/JSONL files with artist, track, video_id columns")
+    parser.add_argument("--db", default=YT_INDEX_DB, help="index database path")
+    args = parser.parse_args()
+
+    index = VideoIndex(path=args.db)
+    for file_path in args.files:
+        index.preload(file_path)